@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fatpy")
+)
+
+from filesystem import FileSystem  # noqa: E402
+from mkfs import mkfs, parse_size  # noqa: E402
+from util import FileDescriptor  # noqa: E402
+
+DEFAULT_SIZES = "64M,512M"
+DEFAULT_FANOUTS = "100,1000"
+DEFAULT_DEPTHS = "1,4,16"
+READ_SIZE = 8 << 20
+
+
+def measure(function, repeat):
+    """Run `function` `repeat` times, return the best time and the peak
+    memory traced during one more run.
+
+    Tracing slows down every allocation, by how much depends on the code
+    measured, so the timed runs are made with it off.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        function()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def make_image(workdir, size, name):
+    # A fresh file per benchmark, earlier images may still be mapped
+    path = os.path.join(workdir, f"{name}-{size}.img")
+    mkfs(path, parse_size(size))
+    return path
+
+
+def bench_mount(path, repeat):
+    return measure(lambda: FileSystem(path), repeat)
+
+
+def bench_follow_path(path, depth, repeat):
+    fs = FileSystem(path, writable=True)
+    fat = fs.fat[min(fs.fat)]
+    names = [f"d{i}" for i in range(depth)]
+    for i in range(depth):
+        fat.f_opendir("/" + "/".join(names[: i + 1]))
+    target = "/" + "/".join(names)
+
+    def cold():
+        fat.dcache.clear()
+        fat.path_cache.clear()
+        fat.follow_path(target)
+
+    return measure(cold, repeat), measure(lambda: fat.follow_path(target), repeat)
+
+
+def bench_allocation(path, n, repeat):
+    """Allocate `n` clusters on a FAT where every other cluster is in use."""
+    fs = FileSystem(path, writable=True)
+    fat = fs.fat[min(fs.fat)]
+    for cluster in range(2, fat.n_clusters + 2, 2):
+        fat.write_fat(cluster, fat.end_of_file)
+
+    def allocate():
+        clusters = []
+        for _ in range(n):
+            cluster = fat.scan_fat()
+            fat.write_fat(cluster, fat.end_of_file)
+            clusters.append(cluster)
+        for cluster in clusters:
+            fat.write_fat(cluster, 0)
+
+    return measure(allocate, repeat)
+
+
+def bench_readdir(path, fanout, repeat):
+    fs = FileSystem(path, writable=True)
+    fat = fs.fat[min(fs.fat)]
+    fat.f_opendir("/wide")
+    for i in range(fanout):
+        fat.f_close(fat.f_open(f"/wide/f{i}"))
+    dp = fat.follow_path("/wide")
+    return measure(lambda: fat.f_readdir(dp), repeat)
+
+
+def bench_read(path, repeat):
+    fs = FileSystem(path, writable=True)
+    fat = fs.fat[min(fs.fat)]
+    fp = fat.f_open("/big")
+    fat.f_write(fp, os.urandom(READ_SIZE))
+    fp = FileDescriptor(fp.cluster, fp.sector, fp.attr, fp.dir_sector, fp.size)
+    return measure(lambda: fat.f_pread(fp), repeat)
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, fanouts, depths, repeat, workdir):
+    results = []
+
+    def record(name, params, timing):
+        seconds, peak = timing
+        results.append(
+            {"name": name, "params": params, "seconds": seconds, "peak_bytes": peak}
+        )
+
+    for size in sizes:
+        path = make_image(workdir, size, "mount")
+        record("mount", {"size": size}, bench_mount(path, repeat))
+        for depth in depths:
+            path = make_image(workdir, size, f"depth{depth}")
+            cold, warm = bench_follow_path(path, depth, repeat)
+            record("follow_path_cold", {"size": size, "depth": depth}, cold)
+            record("follow_path_warm", {"size": size, "depth": depth}, warm)
+        record(
+            "scan_fat_fragmented",
+            {"size": size, "n": 1000},
+            bench_allocation(make_image(workdir, size, "scan"), 1000, repeat),
+        )
+        for fanout in fanouts:
+            record(
+                "f_readdir",
+                {"size": size, "fanout": fanout},
+                bench_readdir(
+                    make_image(workdir, size, f"fanout{fanout}"), fanout, repeat
+                ),
+            )
+        seconds, peak = bench_read(make_image(workdir, size, "read"), repeat)
+        record("f_read", {"size": size, "bytes": READ_SIZE}, (seconds, peak))
+        results[-1]["mb_per_second"] = READ_SIZE / seconds / (1 << 20)
+
+    return {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """Print the time ratio new/old for every benchmark present in both."""
+
+    def key(result):
+        return result["name"], json.dumps(result["params"], sort_keys=True)
+
+    before = {key(result): result for result in old["results"]}
+    for result in new["results"]:
+        if key(result) in before:
+            ratio = result["seconds"] / before[key(result)]["seconds"]
+            print(f"{result['name']:<22} {key(result)[1]:<40} {ratio:6.2f}x")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=DEFAULT_SIZES)
+    parser.add_argument("--fanouts", default=DEFAULT_FANOUTS)
+    parser.add_argument("--depths", default=DEFAULT_DEPTHS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = run(
+            args.sizes.split(","),
+            [int(fanout) for fanout in args.fanouts.split(",")],
+            [int(depth) for depth in args.depths.split(",")],
+            args.repeat,
+            workdir,
+        )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, mode="w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
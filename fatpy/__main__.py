@@ -10,25 +10,51 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("device")
     parser.add_argument("-w", "--write", action="store_true")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument(
+        "-j", "--journal", action="store_true", help="journal writes to DEVICE.journal"
+    )
+    parser.add_argument(
+        "-o", "--overlay", action="store_true", help="keep DEVICE unmodified"
+    )
+    parser.add_argument("--delta", help="store the overlay modifications in DELTA")
+    parser.add_argument(
+        "-s", "--script", help="run the commands in SCRIPT, - reads from stdin"
+    )
 
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    fs = FileSystem(args.device)
+    fs = FileSystem(
+        args.device,
+        args.write,
+        args.profile,
+        args.journal,
+        args.overlay,
+        args.delta,
+    )
     shell = Shell(fs)
 
-    def exit_handler():
-        fs.write_disk(args.device)
+    if args.profile:
+        # Exit handlers run in reverse order, so this runs after the final checkpoint
+        atexit.register(lambda: print(fs.profiler.report(), file=sys.stderr))
+    if fs.writable:
+        atexit.register(fs.checkpoint)
 
-    if args.write:
-        atexit.register(exit_handler)
+    if args.script == "-":
+        shell.run(sys.stdin, sys.stdout)
+        return
+    if args.script:
+        with open(args.script) as script:
+            shell.run(script, sys.stdout)
+        return
 
     while True:
         cmd = input("$ ")
         try:
-            value = shell.parse(cmd)
+            value = shell.execute(cmd)
         except Exception as e:
             value = e
         if value != "":
@@ -0,0 +1,469 @@
+import abc
+import asyncio
+import functools
+import mmap
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fat import Fat
+from filesystem import FileSystem
+from util import SECTOR_LENGTH, Sector, synchronized
+
+IO_WORKERS = 4
+FAT_WORKERS = 8
+CACHE_SIZE = 4 * 1024 * 1024
+
+
+class AsyncBlockDevice(abc.ABC):
+    """Sector addressable image read and written with coroutines.
+
+    Subclasses implement `read_blocks` and `write_blocks`. A read of sectors
+    that a read in flight already covers waits for that read instead of
+    going to the backend.
+    """
+
+    def __init__(self, n_sectors, writable=False, sector_length=SECTOR_LENGTH):
+        self.n_sectors = n_sectors
+        self.writable = writable
+        self.sector_length = sector_length
+        # (first sector, count) -> future of the read in flight
+        self.pending = {}
+
+    def __len__(self):
+        return self.n_sectors
+
+    def covering(self, index, count):
+        """Return (first sector, future) of a read in flight covering the
+        `count` sectors from `index`, None when there is none."""
+        for (first, length), future in self.pending.items():
+            if first <= index and index + count <= first + length:
+                return first, future
+        return None
+
+    async def read(self, index, count=1) -> bytes:
+        found = self.covering(index, count)
+        if found is None:
+            key = (index, count)
+            future = asyncio.ensure_future(self.read_blocks(index, count))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+            found = index, future
+        first, future = found
+        # A cancelled waiter must not cancel the read the others wait for
+        data = await asyncio.shield(future)
+        if first == index and len(data) == count * self.sector_length:
+            return data
+        start = (index - first) * self.sector_length
+        return data[start : start + count * self.sector_length]
+
+    async def write(self, index, buffer):
+        if not self.writable:
+            raise Exception("device is not opened for writing")
+        await self.write_blocks(index, buffer)
+
+    @abc.abstractmethod
+    async def read_blocks(self, index, count) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    async def write_blocks(self, index, buffer):
+        pass
+
+    async def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ThreadedFileDevice(AsyncBlockDevice):
+    """Image file accessed with pread/pwrite on a pool of threads.
+
+    The pool is private to the device: Fat workers block on these reads, so
+    sharing their pool could leave no thread to serve them.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        writable=False,
+        sector_length=SECTOR_LENGTH,
+        workers=IO_WORKERS,
+    ):
+        self.device = device
+        self.fd = os.open(device, os.O_RDWR if writable else os.O_RDONLY)
+        super().__init__(
+            os.fstat(self.fd).st_size // sector_length, writable, sector_length
+        )
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def read_blocks(self, index, count):
+        length = self.sector_length
+        return await self.run(os.pread, self.fd, count * length, index * length)
+
+    async def write_blocks(self, index, buffer):
+        await self.run(os.pwrite, self.fd, buffer, index * self.sector_length)
+
+    async def sync(self):
+        await self.run(os.fsync, self.fd)
+
+    def close(self):
+        self.executor.shutdown()
+        os.close(self.fd)
+
+
+class MirrorDevice:
+    """BlockDevice interface over an AsyncBlockDevice, for Fat running on
+    worker threads.
+
+    Sectors are copied into an anonymous map the first time they are needed,
+    the calling thread waits for the read on the event loop. Writes land in
+    place in the map as they do with BlockDevice.
+
+    The map is the cache of the device: once more than `capacity` bytes are
+    loaded, the clean pages least recently used are given back to the system
+    and loaded again when needed. Pinned and dirty sectors are kept and do
+    not count against the capacity. A view handed out stays valid until
+    `capacity` bytes of other sectors have been loaded.
+    """
+
+    def __init__(self, device: AsyncBlockDevice, loop, capacity=CACHE_SIZE):
+        self.device = device
+        self.loop = loop
+        self.writable = device.writable
+        self.sector_length = device.sector_length
+        self.n_sectors = len(device)
+        self.capacity = capacity
+        self.mm = mmap.mmap(
+            -1, self.n_sectors * self.sector_length, flags=mmap.MAP_PRIVATE
+        )
+        self.view = memoryview(self.mm)
+        self.loaded = bytearray(self.n_sectors)
+        self.page_sectors = max(1, mmap.PAGESIZE // self.sector_length)
+        # Loaded pages that may be evicted, least recently used first
+        self.pages = OrderedDict()
+        # Page -> number of pins covering it
+        self.pins = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = set()
+        self.lock = threading.Lock()
+        # Serializes the write backs, only taken on worker threads
+        self.flushing = threading.Lock()
+
+    def __len__(self):
+        return self.n_sectors
+
+    def wait(self, coroutine):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            coroutine.close()
+            raise Exception("sectors can't be loaded from the event loop thread")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def missing(self, index, count):
+        """Yield (first sector, count) for each run not loaded yet."""
+        end = index + count
+        while index < end:
+            start = self.loaded.find(0, index, end)
+            if start == -1:
+                return
+            index = self.loaded.find(1, start, end)
+            if index == -1:
+                index = end
+            yield start, index - start
+
+    @synchronized
+    def store(self, index, count, data):
+        # Only fill the sectors still missing, another thread may have
+        # loaded and modified some of them in the meantime.
+        for start, n in list(self.missing(index, count)):
+            offset = (start - index) * self.sector_length
+            length = n * self.sector_length
+            position = start * self.sector_length
+            self.view[position : position + length] = data[offset : offset + length]
+            self.loaded[start : start + n] = b"\x01" * n
+            for page in self.page_range(start, n):
+                if not self.pins[page]:
+                    self.pages[page] = None
+                    self.pages.move_to_end(page)
+
+    async def load(self, index, count):
+        for start, n in list(self.missing(index, count)):
+            self.store(start, n, await self.device.read(start, n))
+
+    def page_range(self, index, count):
+        return range(
+            index // self.page_sectors, (index + count - 1) // self.page_sectors + 1
+        )
+
+    def ensure(self, index, count):
+        """Load the sectors missing, mark their pages as recently used and
+        evict pages over the capacity, never the ones of this range."""
+        hit = True
+        while True:
+            with self.lock:
+                if self.loaded.find(0, index, index + count) == -1:
+                    pages = self.page_range(index, count)
+                    for page in pages:
+                        if page in self.pages:
+                            self.pages.move_to_end(page)
+                    if hit:
+                        self.hits += 1
+                    else:
+                        self.misses += 1
+                    self.evict(pages)
+                    return
+            # Loaded sectors may be evicted by another thread before they
+            # are marked, in which case they are loaded again
+            hit = False
+            self.wait(self.load(index, count))
+
+    def evict(self, keep):
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        page_length = self.page_sectors * self.sector_length
+        for page in list(self.pages):
+            if len(self.pages) * page_length <= self.capacity:
+                return
+            first = page * self.page_sectors
+            end = min(first + self.page_sectors, self.n_sectors)
+            if page in keep or any(i in self.dirty for i in range(first, end)):
+                continue
+            del self.pages[page]
+            # Private anonymous pages read as zeros again once released
+            start = first * self.sector_length
+            self.mm.madvise(
+                mmap.MADV_DONTNEED, start, min(page_length, len(self.mm) - start)
+            )
+            self.loaded[first:end] = bytes(end - first)
+            self.evictions += 1
+
+    @synchronized
+    def pin(self, index, count=1):
+        for page in self.page_range(index, count):
+            self.pins[page] += 1
+            self.pages.pop(page, None)
+
+    @synchronized
+    def unpin(self, index, count=1):
+        for page in self.page_range(index, count):
+            self.pins[page] -= 1
+            if not self.pins[page]:
+                del self.pins[page]
+                first = page * self.page_sectors
+                if self.loaded.find(1, first, first + self.page_sectors) != -1:
+                    self.pages[page] = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "capacity": self.capacity,
+            "cached": len(self.pages) * self.page_sectors,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.n_sectors
+        if not 0 <= index < self.n_sectors:
+            raise IndexError("sector index out of range")
+        self.ensure(index, 1)
+        start = index * self.sector_length
+        return Sector(self.view[start : start + self.sector_length])
+
+    def read(self, index, count):
+        self.ensure(index, count)
+        start = index * self.sector_length
+        return self.view[start : start + count * self.sector_length]
+
+    def prefetch(self, index, count):
+        if self.loaded.find(0, index, index + count) != -1:
+            asyncio.run_coroutine_threadsafe(self.load(index, count), self.loop)
+
+    @synchronized
+    def mark_dirty(self, index, count=1):
+        self.dirty.update(range(index, index + count))
+
+    def dirty_runs(self):
+        start = None
+        previous = None
+        for index in sorted(self.dirty):
+            if start is None:
+                start = index
+            elif index != previous + 1:
+                yield start, previous - start + 1
+                start = index
+            previous = index
+        if start is not None:
+            yield start, previous - start + 1
+
+    @synchronized
+    def capture(self):
+        """Return (first sector, data) for every dirty run, a copy taken at
+        once, and start tracking anew."""
+        runs = []
+        for index, count in self.dirty_runs():
+            start = index * self.sector_length
+            runs.append(
+                (index, bytes(self.view[start : start + count * self.sector_length]))
+            )
+        self.dirty.clear()
+        return runs
+
+    async def write_back(self, runs):
+        for index, data in runs:
+            await self.device.write(index, data)
+        await self.device.sync()
+
+    def flush(self):
+        if not self.writable:
+            raise Exception("device is not opened for writing")
+        # The loop thread takes `lock` to store the sectors it loads, so the
+        # lock must not be held while waiting for the loop.
+        with self.flushing:
+            runs = self.capture()
+            try:
+                self.wait(self.write_back(runs))
+            except BaseException:
+                for index, data in runs:
+                    self.mark_dirty(index, len(data) // self.sector_length)
+                raise
+
+
+class MirroredFileSystem(FileSystem):
+    """FileSystem whose sectors come from an AsyncBlockDevice."""
+
+    def __init__(self, device: AsyncBlockDevice, loop, cache_size=CACHE_SIZE):
+        self.loop = loop
+        self.cache_size = cache_size
+        super().__init__(device, device.writable)
+
+    def read_disk(self, device: AsyncBlockDevice, writable=False) -> MirrorDevice:
+        return MirrorDevice(device, self.loop, self.cache_size)
+
+
+class AsyncFat:
+    """Coroutine interface of a Fat.
+
+    Every call runs the synchronous Fat operation on a worker thread, so
+    sector reads never block the event loop and several coroutines can read
+    directories and files of the same image concurrently.
+    """
+
+    def __init__(self, fat: Fat, executor):
+        self.fat = fat
+        self.executor = executor
+
+    async def run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def follow_path(self, path):
+        return await self.run(self.fat.follow_path, path)
+
+    async def f_opendir(self, path):
+        return await self.run(self.fat.f_opendir, path)
+
+    async def f_readdir(self, dp):
+        return await self.run(self.fat.f_readdir, dp)
+
+    async def scandir(self, dp):
+        return await self.run(lambda: list(self.fat.scandir(dp)))
+
+    async def walk(self, path="/", breadth_first=False):
+        iterator = self.fat.walk(path, breadth_first)
+        done = object()
+        while True:
+            item = await self.run(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    async def f_open(self, path):
+        return await self.run(self.fat.f_open, path)
+
+    async def f_close(self, fp):
+        return await self.run(self.fat.f_close, fp)
+
+    async def f_pread(self, fp, offset=0, length=None):
+        return await self.run(self.fat.f_pread, fp, offset, length)
+
+    async def f_readinto(self, fp, buffer, offset=0):
+        return await self.run(self.fat.f_readinto, fp, buffer, offset)
+
+    async def f_write(self, fp, buffer, offset=None):
+        return await self.run(self.fat.f_write, fp, buffer, offset)
+
+    async def f_size(self, fp):
+        return await self.run(self.fat.f_size, fp)
+
+    async def f_unlink(self, path):
+        return await self.run(self.fat.f_unlink, path)
+
+    async def f_rename(self, old_path, new_path):
+        return await self.run(self.fat.f_rename, old_path, new_path)
+
+    async def f_chmod(self, path, attr, mask):
+        return await self.run(self.fat.f_chmod, path, attr, mask)
+
+    async def free_space(self):
+        return await self.run(self.fat.free_space)
+
+
+class AsyncFileSystem:
+    """Coroutine interface of a FileSystem, one AsyncFat per partition.
+
+    Open it with `await AsyncFileSystem.open(path)` or pass any
+    AsyncBlockDevice instead of a path.
+    """
+
+    def __init__(self, fs: FileSystem, executor):
+        self.fs = fs
+        self.executor = executor
+        self.fat = {i: AsyncFat(fs.fat[i], executor) for i in fs.fat}
+
+    @classmethod
+    async def open(
+        cls, device, writable=False, workers=FAT_WORKERS, cache_size=CACHE_SIZE
+    ):
+        if isinstance(device, str):
+            device = ThreadedFileDevice(device, writable)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        fs = await loop.run_in_executor(
+            executor, MirroredFileSystem, device, loop, cache_size
+        )
+        return cls(fs, executor)
+
+    async def sync(self):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.fs.sync)
+
+    async def close(self):
+        if self.fs.writable:
+            await self.sync()
+        self.executor.shutdown()
+        # The map is released with the last sector view, only the backend
+        # holds resources to give back.
+        self.fs.sectors.device.device.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
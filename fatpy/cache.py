@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict
+
+from util import synchronized
+
+
+class LruCache:
+    """Mapping bounded to `capacity` items, evicting the least recently used."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    @synchronized
+    def get(self, key, default=None):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return default
+        return self.items[key]
+
+    @synchronized
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    @synchronized
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    @synchronized
+    def clear(self):
+        self.items.clear()
+
+
+class BlockCache:
+    """Sector layer between Fat and the block device.
+
+    The sectors the device hands out are zero-copy views, nothing is copied
+    or kept here. A BlockDevice maps the image and the page cache of the
+    kernel is its cache, a MirrorDevice bounds the sectors it keeps itself
+    and reports its hits and evictions. Pinned sectors (the FAT and the fixed
+    root directory), touched by nearly every operation, keep their Sector
+    wrapper and are never evicted. Lookups are counted for `stats`. Writes go
+    to the sectors of the device, dirty tracking and flushing are delegated
+    to it.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.sector_length = device.sector_length
+        self.pinned = {}
+        self.lookups = 0
+        self.pinned_lookups = 0
+        self.reads = 0
+        self.sectors_read = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.device)
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def __getitem__(self, index):
+        # The device may wait for a read, it is called without the lock
+        with self.lock:
+            self.lookups += 1
+            sector = self.pinned.get(index)
+            if sector is not None:
+                self.pinned_lookups += 1
+                return sector
+        return self.device[index]
+
+    def read(self, index, count):
+        with self.lock:
+            self.reads += 1
+            self.sectors_read += count
+        return self.device.read(index, count)
+
+    def prefetch(self, index, count):
+        self.device.prefetch(index, count)
+
+    def mark_dirty(self, index, count=1):
+        self.device.mark_dirty(index, count)
+
+    def flush(self):
+        self.device.flush()
+
+    def pin(self, index, count=1):
+        self.device.pin(index, count)
+        # A single read loads the range on devices fetching sectors on demand
+        self.device.read(index, count)
+        sectors = {i: self.device[i] for i in range(index, index + count)}
+        with self.lock:
+            self.pinned.update(sectors)
+
+    def unpin(self, index, count=1):
+        with self.lock:
+            for i in range(index, index + count):
+                self.pinned.pop(i, None)
+        self.device.unpin(index, count)
+
+    def stats(self):
+        stats = {
+            "pinned": len(self.pinned),
+            "lookups": self.lookups,
+            "pinned_lookups": self.pinned_lookups,
+            "reads": self.reads,
+            "sectors_read": self.sectors_read,
+            "dirty": len(self.device.dirty),
+        }
+        stats.update(self.device.stats())
+        return stats
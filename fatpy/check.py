@@ -0,0 +1,239 @@
+from array import array
+from dataclasses import dataclass
+
+from fat import Fat, entry_cluster, entry_name, is_free
+from lfn import with_long_names
+from table import UINT32, np
+from util import DirectoryAttr, FatEntry
+
+
+@dataclass
+class Problem:
+    kind: str
+    message: str
+    repaired: bool = False
+
+    def __str__(self):
+        suffix = " (repaired)" if self.repaired else ""
+        return f"{self.kind}: {self.message}{suffix}"
+
+
+def check_fat_copies(fat: Fat, repair):
+    problems = []
+    first = fat.read_sectors(fat.first_fat_sector, fat.n_sectors_per_fat)
+    for i in range(1, fat.bpb.n_fats):
+        first_sector = fat.first_fat_sector + i * fat.n_sectors_per_fat
+        copy = fat.read_sectors(first_sector, fat.n_sectors_per_fat)
+        if copy == first:
+            continue
+        n_entries = len(fat.table)
+        a = fat.table.decode(first, n_entries)
+        b = fat.table.decode(copy, n_entries)
+        if np:
+            a = np.frombuffer(a, dtype=a.typecode)
+            b = np.frombuffer(b, dtype=b.typecode)
+            n_different = int(np.count_nonzero(a != b))
+        else:
+            n_different = sum(x != y for x, y in zip(a, b))
+        problem = Problem(
+            "fat-mismatch", f"FAT copy {i} differs in {n_different} entries"
+        )
+        if repair:
+            fat.write_sectors(first_sector, 0, bytes(first))
+            problem.repaired = True
+        problems.append(problem)
+    return problems
+
+
+def check_chains(fat: Fat, repair):
+    problems = []
+    for cluster in fat.table.invalid_links():
+        cluster = int(cluster)
+        problem = Problem(
+            "invalid-link",
+            f"cluster {cluster} links to {fat.table[cluster]}",
+        )
+        if repair:
+            fat.write_fat(cluster, fat.end_of_file)
+            problem.repaired = True
+        problems.append(problem)
+    return problems
+
+
+def check_cross_links(fat: Fat, chains, repair):
+    """Give every cluster to a single chain of `chains`, a list of (name,
+    head) where the first chains have priority.
+
+    A chain running into a cluster of another is cut before it, so that no
+    repair afterwards frees or truncates clusters another chain reaches. The
+    heads belong to their own chain whatever the order.
+    """
+    problems = []
+    table = fat.table
+    owner = array(UINT32, bytes(4 * len(table)))
+    names = {}
+    for name, head in chains:
+        owner[head] = head
+        names[head] = name
+    for name, head in chains:
+        previous, cluster = head, table[head]
+        while table.is_cluster(cluster) and not owner[cluster]:
+            owner[cluster] = head
+            previous, cluster = cluster, table[cluster]
+        # A chain looping on itself is reported by the tree check
+        if not table.is_cluster(cluster) or owner[cluster] == head:
+            continue
+        problem = Problem(
+            "cross-linked",
+            f"{name} runs into cluster {cluster} of {names[owner[cluster]]}",
+        )
+        if repair:
+            fat.write_fat(previous, fat.end_of_file)
+            problem.repaired = True
+        problems.append(problem)
+    return problems
+
+
+def truncate_chain(fat: Fat, start, n_clusters):
+    chain = fat.table.chain(start)
+    fat.write_fat(int(chain[n_clusters - 1]), fat.end_of_file)
+    fat.table.release(chain[n_clusters:])
+
+
+def check_tree(fat: Fat, lengths, repair):
+    """Walk the directory tree iteratively, checking the entries and the
+    directory chains. Returns the problems, the (path, head) of the chains
+    referenced and the files to check with `check_sizes`."""
+    problems = []
+    referenced = bytearray(len(fat.table))
+    chains = []
+    files = []
+    if fat.root_cluster:
+        referenced[fat.root_cluster] = 1
+        chains.append(("/", fat.root_cluster))
+    visited = {0}
+    stack = [("", 0, 0)]
+    while stack:
+        path, cluster, parent = stack.pop()
+        dots = set()
+        entries = with_long_names(fat.entries_in_directory(cluster))
+        for sector_index, offset, entry, long_name in entries:
+            if is_free(entry):
+                continue
+            if entry.attr & DirectoryAttr.ATTR_VOLUME_ID:
+                continue
+
+            name = long_name or entry_name(entry)
+            start = entry_cluster(entry)
+            if name in (".", ".."):
+                expected = cluster if name == "." else parent
+                dots.add(name)
+                if cluster != 0 and start != expected:
+                    problem = Problem(
+                        "bad-dot",
+                        f"{path}/{name} points to {start} instead of {expected}",
+                    )
+                    if repair:
+                        entry.first_cluster_lo = expected & 0xFFFF
+                        entry.first_cluster_hi = expected >> 16
+                        fat.write_sector(sector_index, offset, entry.to_bytes())
+                        problem.repaired = True
+                    problems.append(problem)
+                continue
+
+            entry_path = f"{path}/{name}"
+            if start == 0:
+                if entry.file_size != 0:
+                    problems.append(
+                        Problem("size-mismatch", f"{entry_path} has no clusters")
+                    )
+                continue
+            if not fat.table.is_cluster(start):
+                problems.append(
+                    Problem("invalid-start", f"{entry_path} starts at {start}")
+                )
+                continue
+            if referenced[start]:
+                problems.append(
+                    Problem("cross-linked", f"{entry_path} shares cluster {start}")
+                )
+                continue
+            referenced[start] = 1
+            chains.append((entry_path, start))
+
+            if int(lengths[start]) == -1:
+                problems.append(Problem("loop", f"{entry_path} chain loops"))
+                continue
+
+            if entry.attr & DirectoryAttr.ATTR_DIRECTORY:
+                if start not in visited:
+                    visited.add(start)
+                    stack.append((entry_path, start, cluster))
+                continue
+            files.append((entry_path, start, sector_index, offset, entry.file_size))
+
+        if cluster != 0 and dots != {".", ".."}:
+            problems.append(Problem("missing-dot", f"{path} lacks . or .. entries"))
+    return problems, chains, files
+
+
+def check_sizes(fat: Fat, files, lengths, repair):
+    """Check the size of every file of `files` against its chain length."""
+    problems = []
+    for path, start, sector_index, offset, size in files:
+        length = int(lengths[start])
+        expected = -(-size // fat.n_bytes_per_cluster)
+        if length == -1 or expected == length or (expected == 0 and length == 1):
+            continue
+        problem = Problem(
+            "size-mismatch", f"{path} has {size} bytes in {length} clusters"
+        )
+        if repair:
+            if length > expected:
+                truncate_chain(fat, start, max(expected, 1))
+            else:
+                entry = FatEntry(fat.read_sector(sector_index), offset)
+                entry.file_size = length * fat.n_bytes_per_cluster
+                fat.write_sector(sector_index, offset, entry.to_bytes())
+            problem.repaired = True
+        problems.append(problem)
+    return problems
+
+
+def check_lost(fat: Fat, lost, repair):
+    problems = []
+    for head in lost:
+        chain = fat.table.chain(head)
+        problem = Problem(
+            "lost-chain", f"{len(chain)} clusters from {head} are unreferenced"
+        )
+        if repair:
+            fat.table.release(chain)
+            problem.repaired = True
+        problems.append(problem)
+    return problems
+
+
+def check(fat: Fat, repair=False) -> list[Problem]:
+    """Check the consistency of the FAT copies, the cluster chains and the
+    directory tree, optionally repairing what can be repaired."""
+    with fat.lock:
+        problems = check_fat_copies(fat, repair)
+        problems += check_chains(fat, repair)
+        lengths = fat.table.chain_lengths()
+        tree_problems, chains, files = check_tree(fat, lengths, repair)
+        problems += tree_problems
+        starts = [head for _path, head in chains]
+        lost = [int(head) for head in fat.table.lost_chains(starts)]
+        # Cross links are cut first, the chains are disjoint for the repairs
+        # freeing clusters below
+        chains += [(f"lost chain {head}", head) for head in lost]
+        problems += check_cross_links(fat, chains, repair)
+        if repair:
+            lengths = fat.table.chain_lengths()
+        problems += check_sizes(fat, files, lengths, repair)
+        problems += check_lost(fat, lost, repair)
+        if repair:
+            fat.dcache.clear()
+            fat.path_cache.clear()
+    return problems
@@ -0,0 +1,264 @@
+from array import array
+from dataclasses import dataclass
+
+from check import check, truncate_chain
+from fat import DELETED_ENTRY, N_FAT_ENTRY, Fat, entry_cluster, is_free
+from table import FIRST_CLUSTER
+from util import DirectoryAttr, LfnEntry
+
+FLIP = bytes.maketrans(b"\x00\x01", b"\x01\x00")
+
+
+@dataclass
+class Fragmentation:
+    n_chains: int = 0
+    n_fragmented: int = 0
+    n_extents: int = 0
+    n_clusters: int = 0
+    n_free_extents: int = 0
+
+    def add(self, runs):
+        self.n_chains += 1
+        self.n_fragmented += len(runs) > 1
+        self.n_extents += len(runs)
+        self.n_clusters += sum(length for _first, length in runs)
+
+    def __str__(self):
+        return (
+            f"{self.n_chains} chains, {self.n_fragmented} fragmented, "
+            f"{self.n_clusters} clusters in {self.n_extents} extents, "
+            f"free space in {self.n_free_extents} extents"
+        )
+
+
+def is_live(entry):
+    return (
+        not isinstance(entry, LfnEntry)
+        and not is_free(entry)
+        and not entry.attr & DirectoryAttr.ATTR_VOLUME_ID
+    )
+
+
+def compact_directory(fat: Fat, cluster):
+    """Move the entries of the directory to its front, dropping free and
+    deleted slots and long name slots left without their entry, and free
+    the clusters it no longer needs."""
+    extents = list(fat.directory_extents(cluster))
+    data = b"".join(bytes(fat.read_sectors(first, n)) for first, n in extents)
+    slots = []
+    pending = []
+    for offset in range(0, len(data), N_FAT_ENTRY):
+        slot = data[offset : offset + N_FAT_ENTRY]
+        if slot[0] in (0, DELETED_ENTRY):
+            pending = []
+        elif slot[11] == DirectoryAttr.ATTR_LONG_NAME:
+            pending.append(slot)
+        else:
+            slots += pending
+            slots.append(slot)
+            pending = []
+    compacted = b"".join(slots)
+
+    head = fat.directory_cluster(cluster)
+    size = len(data)
+    if head != 0:
+        n_clusters = max(1, -(-len(compacted) // fat.n_bytes_per_cluster))
+        if n_clusters * fat.n_bytes_per_cluster < size:
+            truncate_chain(fat, head, n_clusters)
+            extents = list(fat.directory_extents(cluster))
+            size = n_clusters * fat.n_bytes_per_cluster
+    compacted = compacted.ljust(size, b"\x00")
+    if compacted == data[:size]:
+        return
+    position = 0
+    for first, n_sectors in extents:
+        length = n_sectors * fat.bpb.n_bytes_per_sector
+        fat.write_sectors(first, 0, compacted[position : position + length])
+        position += length
+
+
+def tree_chains(fat: Fat, compact=False):
+    """Return the first cluster of every chain of the tree, each directory
+    followed by its content, compacting the directories first if asked to."""
+    heads = [fat.root_cluster] if fat.root_cluster else []
+    stack = [0]
+    while stack:
+        cluster = stack.pop()
+        if compact:
+            compact_directory(fat, cluster)
+        directories = []
+        for _sector_index, _offset, entry in fat.entries_in_directory(cluster):
+            if not is_live(entry) or entry.name[0] == ".":
+                continue
+            start = entry_cluster(entry)
+            if start == 0:
+                continue
+            heads.append(start)
+            if entry.attr & DirectoryAttr.ATTR_DIRECTORY:
+                directories.append(start)
+        stack.extend(reversed(directories))
+    return heads
+
+
+def measure(fat: Fat, heads):
+    metrics = Fragmentation()
+    for head in heads:
+        metrics.add(fat.table.runs(head))
+    # Clusters 0 and 1 are never free, so every free run follows a used cluster
+    metrics.n_free_extents = fat.table.free.count(b"\x00\x01")
+    return metrics
+
+
+def fragmentation(fat: Fat) -> Fragmentation:
+    with fat.lock:
+        return measure(fat, tree_chains(fat))
+
+
+def plan(fat: Fat, chains):
+    """Lay the chains out one after the other from the first cluster.
+
+    Returns the new clusters of every chain and the copies putting them
+    there, as (source, destination, cluster count) runs to apply in order.
+    Data in the way of a chain is first moved to the last free cluster.
+    """
+    table = fat.table
+    n = len(table)
+    # Physical cluster -> original cluster of the data it holds, -1 if none
+    owner = array("l", [-1]) * n
+    # Original cluster -> physical cluster now holding its data
+    location = {}
+    for chain in chains:
+        for cluster in chain:
+            owner[cluster] = cluster
+            location[cluster] = cluster
+    # 1 where a cluster can receive data
+    available = bytearray(table.free)
+    # 1 for the allocated clusters outside the chains, like bad clusters,
+    # which stay where they are
+    fixed = table.free.translate(FLIP)
+    fixed[:FIRST_CLUSTER] = bytes(FIRST_CLUSTER)
+    for chain in chains:
+        for cluster in chain:
+            fixed[cluster] = 0
+
+    copies = []
+
+    def move(cluster, destination):
+        source = location[cluster]
+        owner[source] = -1
+        available[source] = 1
+        owner[destination] = cluster
+        available[destination] = 0
+        location[cluster] = destination
+        if copies:
+            first, target, count = copies[-1]
+            # A copy to lower clusters may overlap its source, it reads
+            # every cluster before writing over it like memmove does
+            if (
+                first + count == source
+                and target + count == destination
+                and (target < first or target >= source + 1)
+            ):
+                copies[-1] = (first, target, count + 1)
+                return
+        copies.append((source, destination, 1))
+
+    targets = []
+    cursor = FIRST_CLUSTER
+    for chain in chains:
+        target = []
+        for cluster in chain:
+            while fixed[cursor]:
+                cursor += 1
+            destination = cursor
+            cursor += 1
+            target.append(destination)
+            if location[cluster] == destination:
+                continue
+            occupant = owner[destination]
+            if occupant != -1:
+                spare = available.rfind(1)
+                if spare == -1:
+                    raise Exception("no free clusters")
+                move(occupant, spare)
+            move(cluster, destination)
+        targets.append(target)
+    return targets, copies
+
+
+def relink(fat: Fat, moved):
+    """Point the directory entries at the new first clusters, `moved` maps
+    the former ones to them."""
+    stack = [0]
+    while stack:
+        cluster = stack.pop()
+        for sector_index, offset, entry in fat.entries_in_directory(cluster):
+            if not is_live(entry):
+                continue
+            start = entry_cluster(entry)
+            if start in moved:
+                start = moved[start]
+                entry.first_cluster_lo = start & 0xFFFF
+                entry.first_cluster_hi = start >> 16
+                fat.write_sector(sector_index, offset, entry.to_bytes())
+            if (
+                entry.attr & DirectoryAttr.ATTR_DIRECTORY
+                and entry.name[0] != "."
+                and start != 0
+            ):
+                stack.append(start)
+
+
+def move_root(fat: Fat, cluster):
+    """Store the new first cluster of the FAT32 root directory in the boot
+    sector and its backup."""
+    fat.root_cluster = cluster
+    fat.first_root_dir_sector = fat.first_sector_of_cluster(cluster)
+    fat.bpb.root_cluster = cluster
+    boot_sectors = [fat.partition.sector]
+    if fat.bpb.backup_boot_sector not in (0, 0xFFFF):
+        boot_sectors.append(fat.partition.sector + fat.bpb.backup_boot_sector)
+    for sector_index in boot_sectors:
+        fat.write_sector(sector_index, 0, fat.bpb.to_bytes())
+
+
+def defrag(fat: Fat):
+    """Compact the directories and store every chain contiguously, in tree
+    order from the start of the data area.
+
+    Data is moved in runs of clusters, then the FAT is rewritten at once
+    and the directory entries relinked. Open file descriptors are stale
+    afterwards. Returns the fragmentation before and after.
+    """
+    with fat.lock:
+        if check(fat):
+            raise Exception("file system has errors, check it first")
+        before = measure(fat, tree_chains(fat))
+        heads = tree_chains(fat, compact=True)
+        chains = [[int(cluster) for cluster in fat.table.chain(head)] for head in heads]
+        targets, copies = plan(fat, chains)
+
+        n_sectors_per_cluster = fat.bpb.n_sectors_per_cluster
+        for source, destination, count in copies:
+            data = fat.read_sectors(
+                fat.first_sector_of_cluster(source), count * n_sectors_per_cluster
+            )
+            fat.write_sectors(fat.first_sector_of_cluster(destination), 0, data)
+        fat.table.relocate(zip(chains, targets))
+
+        moved = {
+            chain[0]: target[0]
+            for chain, target in zip(chains, targets)
+            if chain[0] != target[0]
+        }
+        if fat.root_cluster in moved:
+            move_root(fat, moved[fat.root_cluster])
+        relink(fat, moved)
+        if fat.cwd.cluster in moved:
+            fat.cwd.cluster = moved[fat.cwd.cluster]
+        fat.cwd.sector = fat.sector_of_directory(fat.cwd.cluster)
+        fat.dcache.clear()
+        fat.path_cache.clear()
+        fat.slot_hints.clear()
+        fat.free_slots.clear()
+        return before, measure(fat, [target[0] for target in targets])
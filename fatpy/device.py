@@ -0,0 +1,124 @@
+import mmap
+import os
+import threading
+
+from util import SECTOR_LENGTH, Sector, synchronized
+
+
+class BlockDevice:
+    """Sector addressable view of a disk image backed by a private mmap.
+
+    Nothing is read up front, pages are faulted in when a sector is first
+    touched. Modifications stay in memory until `flush` writes the dirty
+    sectors back to the image.
+    """
+
+    def __init__(self, device: str, writable=False, sector_length=SECTOR_LENGTH):
+        self.device = device
+        self.writable = writable
+        self.sector_length = sector_length
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.fd = os.open(device, os.O_RDWR if writable else os.O_RDONLY)
+        size = os.fstat(self.fd).st_size
+        self.mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_COPY)
+        self.view = memoryview(self.mm)
+        self.n_sectors = size // sector_length
+
+    def __len__(self):
+        return self.n_sectors
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.n_sectors
+        if not 0 <= index < self.n_sectors:
+            raise IndexError("sector index out of range")
+        start = index * self.sector_length
+        return Sector(self.view[start : start + self.sector_length])
+
+    def read(self, index, count):
+        """Return a zero-copy view of `count` consecutive sectors."""
+        start = index * self.sector_length
+        return self.view[start : start + count * self.sector_length]
+
+    def prefetch(self, index, count):
+        """Ask the kernel to start paging in `count` sectors from `index`."""
+        if not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        start = index * self.sector_length
+        aligned = start - start % mmap.PAGESIZE
+        length = start + count * self.sector_length - aligned
+        self.mm.madvise(
+            mmap.MADV_WILLNEED, aligned, min(length, len(self.mm) - aligned)
+        )
+
+    def __iter__(self):
+        for i in range(self.n_sectors):
+            yield self[i]
+
+    def pin(self, index, count=1):
+        """Nothing to keep, the kernel pages the map in and out."""
+
+    def unpin(self, index, count=1):
+        pass
+
+    def stats(self):
+        return {}
+
+    @synchronized
+    def mark_dirty(self, index, count=1):
+        self.dirty.update(range(index, index + count))
+
+    def dirty_runs(self):
+        """Yield (first sector, sector count) for each contiguous dirty run."""
+        start = None
+        previous = None
+        for index in sorted(self.dirty):
+            if start is None:
+                start = index
+            elif index != previous + 1:
+                yield start, previous - start + 1
+                start = index
+            previous = index
+        if start is not None:
+            yield start, previous - start + 1
+
+    @synchronized
+    def capture(self):
+        """Return (first sector, data) for every dirty run, a copy taken at
+        once, and start tracking anew."""
+        runs = []
+        for index, count in self.dirty_runs():
+            start = index * self.sector_length
+            runs.append(
+                (index, bytes(self.view[start : start + count * self.sector_length]))
+            )
+        self.dirty.clear()
+        return runs
+
+    def write_runs(self, runs):
+        if not self.writable:
+            raise Exception("device is not opened for writing")
+        for index, data in runs:
+            os.pwrite(self.fd, data, index * self.sector_length)
+
+    @synchronized
+    def apply(self, runs):
+        """Copy the (first sector, data) runs into memory, as modifications."""
+        for index, data in runs:
+            start = index * self.sector_length
+            self.view[start : start + len(data)] = data
+            self.dirty.update(range(index, index + len(data) // self.sector_length))
+
+    def flush(self):
+        if not self.writable:
+            raise Exception("device is not opened for writing")
+        self.write_runs(self.capture())
+
+    def fsync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+        os.close(self.fd)
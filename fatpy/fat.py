@@ -1,16 +1,44 @@
+import threading
+import weakref
+from collections import deque
+from itertools import islice
+
+from cache import LruCache
+from handle import FileHandle
+from lfn import (
+    LAST_LONG_ENTRY,
+    ORDER_MASK,
+    LongName,
+    checksum,
+    encode_long_name,
+    generate_short_name,
+    short_name,
+    to_short_name,
+    with_long_names,
+)
+from table import TABLES, fat_type
 from util import (
     BpbFat16,
+    BpbFat32,
     DirectoryAttr,
     DirectoryDescriptor,
     FatEntry,
     FileDescriptor,
     FileInfo,
+    FsInfo,
+    LfnEntry,
     fat_fields,
-    pack,
+    synchronized,
 )
 
-END_OF_FILE = 0xFFFF
+FSINFO_LEAD_SIGNATURE = 0x41615252
+FSINFO_STRUCT_SIGNATURE = 0x61417272
+FSINFO_TRAIL_SIGNATURE = 0xAA550000
 N_FAT_ENTRY = 32
+DELETED_ENTRY = 0xE5
+DCACHE_SIZE = 256
+PATH_CACHE_SIZE = 1024
+PREFETCH_DIRECTORIES = 8
 
 
 def entry(name, attr, cluster):
@@ -24,47 +52,71 @@ def entry(name, attr, cluster):
         "last_accessed_date": 0x03,
         "modified_time": 0x04,
         "modified_date": 0x05,
-        "first_cluster_lo": cluster,
-        "first_cluster_hi": 0,
+        "first_cluster_lo": cluster & 0xFFFF,
+        "first_cluster_hi": cluster >> 16,
         "file_size": 0,
     }
 
 
+def root_dir_sector_count(n_root_entries, n_bytes_per_sector):
+    return (
+        (n_root_entries * N_FAT_ENTRY) + (n_bytes_per_sector - 1)
+    ) // n_bytes_per_sector
+
+
+def data_sector_count(
+    total_sectors, n_reserved_sectors, n_fats, n_sectors_per_fat, n_root_dir_sectors
+):
+    return total_sectors - (
+        n_reserved_sectors + (n_fats * n_sectors_per_fat) + n_root_dir_sectors
+    )
+
+
+def entry_name(entry):
+    return short_name(entry.name)
+
+
+def entry_cluster(entry):
+    return entry.first_cluster_hi << 16 | entry.first_cluster_lo
+
+
+def is_free(entry):
+    """A slot is free when the first byte of its name is 0 or 0xE5, whatever
+    its attributes."""
+    return ord(entry.name[0]) in (0, DELETED_ENTRY)
+
+
 def encode_entry(**kwargs):
     assert len(kwargs) == len(
         fat_fields
     ), f"kwargs: {len(kwargs)} fat_fields: {len(fat_fields)}"
-    buffer = [0] * N_FAT_ENTRY
-    for field in fat_fields:
-        assert field.name in kwargs
-        if field.c_string:
-            buffer_value = [ord(c) for c in kwargs[field.name]]
-            while len(buffer_value) < field.length:
-                buffer_value.append(0)
-        else:
-            buffer_value = pack(kwargs[field.name], field.length)
-
-        for i in range(field.length):
-            index = field.offset + i
-            buffer[index] = buffer_value[i]
-    return buffer
+    return FatEntry.encode(kwargs)
 
 
 class Fat:
     def __init__(self, sectors, partition):
         self.sectors = sectors
         self.partition = partition
+        # Serializes operations that modify the partition
+        self.lock = threading.RLock()
         self.bpb = BpbFat16(self.sectors[self.partition.sector])
+        # The 16-bit FAT size is 0 on FAT32, its BPB has a 32-bit one instead
+        if self.bpb.n_sectors_per_fat16 == 0:
+            self.bpb = BpbFat32(self.sectors[self.partition.sector])
+            self.n_sectors_per_fat = self.bpb.n_sectors_per_fat32
+        else:
+            self.n_sectors_per_fat = self.bpb.n_sectors_per_fat16
 
-        self.total_sectors = self.bpb.small_sector_count
-        self.n_sectors_per_fat = self.bpb.n_sectors_per_fat16
-        self.n_root_dir_sectors = (
-            (self.bpb.n_root_entries * N_FAT_ENTRY) + (self.bpb.n_bytes_per_sector - 1)
-        ) // self.bpb.n_bytes_per_sector
-        self.data_sectors = self.total_sectors - (
-            self.bpb.n_reserved_sectors
-            + (self.bpb.n_fats * self.n_sectors_per_fat)
-            + self.n_root_dir_sectors
+        self.total_sectors = self.bpb.small_sector_count or self.bpb.large_sector_count
+        self.n_root_dir_sectors = root_dir_sector_count(
+            self.bpb.n_root_entries, self.bpb.n_bytes_per_sector
+        )
+        self.data_sectors = data_sector_count(
+            self.total_sectors,
+            self.bpb.n_reserved_sectors,
+            self.bpb.n_fats,
+            self.n_sectors_per_fat,
+            self.n_root_dir_sectors,
         )
 
         self.first_data_sector = (
@@ -75,15 +127,49 @@ class Fat:
         )
         self.first_fat_sector = self.bpb.n_reserved_sectors + self.partition.sector
         self.n_clusters = self.data_sectors // self.bpb.n_sectors_per_cluster
-        # On FAT 12/16 the root directory is at a fixed position immediately after the FAT
-        self.first_root_dir_sector = self.first_data_sector - self.n_root_dir_sectors
+        self.n_bytes_per_cluster = (
+            self.bpb.n_sectors_per_cluster * self.bpb.n_bytes_per_sector
+        )
+        self.fat_type = fat_type(self.n_clusters)
+        if self.fat_type == 32:
+            # The root directory is a cluster chain like any other directory.
+            # Cluster 0 still stands for it, as in the ".." entries.
+            self.root_cluster = self.bpb.root_cluster
+            self.first_root_dir_sector = self.first_sector_of_cluster(self.root_cluster)
+        else:
+            # On FAT 12/16 the root directory is at a fixed position immediately after the FAT
+            self.root_cluster = 0
+            self.first_root_dir_sector = (
+                self.first_data_sector - self.n_root_dir_sectors
+            )
 
         self.cwd = DirectoryDescriptor(
             0, self.first_root_dir_sector, DirectoryAttr.ATTR_DIRECTORY
         )
+        # The FAT and the fixed root directory are touched by nearly every
+        # operation, their Sector wrappers are kept instead of made per lookup.
+        self.sectors.pin(
+            self.first_fat_sector, self.bpb.n_fats * self.n_sectors_per_fat
+        )
+        self.sectors.pin(self.first_root_dir_sector, self.n_root_dir_sectors)
+        self.table = TABLES[self.fat_type](self)
+        self.end_of_file = self.table.end_of_file
+        self.fsinfo = self.read_fsinfo()
+        # Directory cluster -> {name: (sector_index, offset, cluster, attr)}
+        self.dcache = LruCache(DCACHE_SIZE)
+        # (start cluster, path) -> (cluster, attr) of the resolved directory
+        self.path_cache = LruCache(PATH_CACHE_SIZE)
+        # Directory cluster -> (sector_index, offset) of the last slot handed out
+        self.slot_hints = {}
+        # Directory cluster -> runs of consecutive slots freed by deletes,
+        # each a list of (sector_index, offset) in directory order
+        self.free_slots = {}
+        # (sector_index, offset) of a short entry -> handles open on it
+        self.open_files = {}
 
     def __str__(self):
         fields = [
+            "fat_type",
             "total_sectors",
             "n_sectors_per_fat",
             "n_root_dir_sectors",
@@ -103,6 +189,36 @@ class Fat:
     def get_bpb(self):
         return self.bpb
 
+    def read_fsinfo(self):
+        """Parse the FAT32 FSInfo sector, None when there is no valid one.
+
+        Its next free cluster seeds the allocation hint.
+        """
+        if self.fat_type != 32 or self.bpb.fs_info in (0, 0xFFFF):
+            return None
+        self.fsinfo_sector = self.partition.sector + self.bpb.fs_info
+        fsinfo = FsInfo(self.read_sector(self.fsinfo_sector))
+        if (
+            fsinfo.lead_signature != FSINFO_LEAD_SIGNATURE
+            or fsinfo.struct_signature != FSINFO_STRUCT_SIGNATURE
+            or fsinfo.trail_signature != FSINFO_TRAIL_SIGNATURE
+        ):
+            return None
+        if self.table.is_cluster(fsinfo.next_free):
+            self.table.hint = fsinfo.next_free
+        return fsinfo
+
+    def write_fsinfo(self):
+        """Store the free count and the allocation hint in the FSInfo sector."""
+        if self.fsinfo is None:
+            return
+        free_count, next_free = self.table.n_free, self.table.hint
+        if (free_count, next_free) == (self.fsinfo.free_count, self.fsinfo.next_free):
+            return
+        self.fsinfo.free_count = free_count
+        self.fsinfo.next_free = next_free
+        self.write_sector(self.fsinfo_sector, 0, self.fsinfo.to_bytes())
+
     def get_nonempty(self):
         index = self.partition.sector
         size = self.partition.size
@@ -120,28 +236,26 @@ class Fat:
     def read_sector(self, sector_index):
         return self.sectors[sector_index]
 
+    def read_sectors(self, sector_index, count):
+        return self.sectors.read(sector_index, count)
+
     def write_sector(self, sector_index, offset, buffer):
         data = self.read_sector(sector_index)
-        for i in range(len(buffer)):
-            data[offset + i] = buffer[i]
+        data[offset : offset + len(buffer)] = bytes(buffer)
+        self.sectors.mark_dirty(sector_index)
+
+    def write_sectors(self, sector_index, offset, buffer):
+        n_sectors = -(-(offset + len(buffer)) // self.bpb.n_bytes_per_sector)
+        data = self.read_sectors(sector_index, n_sectors)
+        data[offset : offset + len(buffer)] = buffer
+        self.sectors.mark_dirty(sector_index, n_sectors)
 
     def read_fat(self, cluster):
-        sector_index = (
-            self.first_fat_sector + (cluster * 2) // self.bpb.n_bytes_per_sector
-        )
-        offset_within_sector = (cluster * 2) % self.bpb.n_bytes_per_sector
-        sector = self.read_sector(sector_index)
-        value = sector[offset_within_sector]
-        value |= sector[offset_within_sector + 1] << 8
-        return value
+        return self.table[cluster]
 
+    @synchronized
     def write_fat(self, cluster, value):
-        sector_index = (
-            self.first_fat_sector + (cluster * 2) // self.bpb.n_bytes_per_sector
-        )
-        offset_within_sector = (cluster * 2) % self.bpb.n_bytes_per_sector
-        buffer = [value & 0xFF, value >> 8]
-        self.write_sector(sector_index, offset_within_sector, buffer)
+        self.table[cluster] = value
 
     def first_sector_of_cluster(self, cluster):
         return ((cluster - 2) * self.bpb.n_sectors_per_cluster) + self.first_data_sector
@@ -154,10 +268,20 @@ class Fat:
             self.write_sector(index, 0, buffer)
 
     def scan_fat(self):
-        for cluster in range(self.n_clusters):
-            value = self.read_fat(cluster)
-            if value == 0x0000:
-                return cluster
+        cluster = self.table.find_free()
+        if cluster is None:
+            return self.end_of_file
+        return cluster
+
+    def free_clusters(self):
+        return self.table.n_free
+
+    def free_space(self):
+        return (
+            self.table.n_free
+            * self.bpb.n_sectors_per_cluster
+            * self.bpb.n_bytes_per_sector
+        )
 
     def entries_in_cluster(self, cluster):
         if cluster == 0:
@@ -169,54 +293,281 @@ class Fat:
 
         for i in range(n_sectors):
             sector_index = first_sector_index + i
-            sector = self.read_sector(sector_index)
-            for j in range(self.bpb.n_bytes_per_sector // N_FAT_ENTRY):
-                offset = j * N_FAT_ENTRY
-                yield sector_index, offset, FatEntry(
-                    sector[offset : offset + N_FAT_ENTRY]
-                )
-
-    def scan_for_free_location_in_cluster(self, cluster):
-        for sector_index, offset, entry in self.entries_in_cluster(cluster):
-            if entry.attr == 0:
-                return sector_index, offset
-
-        # Need to check FAT table for the cluster to the next cluster.
-        # Otherwise, allocate new cluster for this cluster entry
-        next_cluster = self.read_fat(cluster)
-        if next_cluster != END_OF_FILE:
-            return self.scan_for_free_location_in_cluster(next_cluster)
+            buffer = self.read_sector(sector_index).bytes
+            for offset in range(0, self.bpb.n_bytes_per_sector, N_FAT_ENTRY):
+                if buffer[offset + 11] == DirectoryAttr.ATTR_LONG_NAME:
+                    yield sector_index, offset, LfnEntry(buffer, offset)
+                else:
+                    yield sector_index, offset, FatEntry(buffer, offset)
+
+    def directory_cluster(self, cluster):
+        """Return the first cluster of the directory `cluster`, 0 for a fixed
+        root directory."""
+        return self.root_cluster if cluster == 0 else cluster
+
+    def entries_in_directory(self, cluster):
+        cluster = self.directory_cluster(cluster)
+        if cluster == 0:
+            yield from self.entries_in_cluster(0)
+            return
+        for current in self.table.chain(cluster):
+            yield from self.entries_in_cluster(int(current))
 
-        next_cluster = self.scan_fat()
-        self.write_fat(cluster, next_cluster)
-        self.write_fat(next_cluster, END_OF_FILE),
+    def directory_extents(self, cluster):
+        """Yield (first sector, sector count) for each contiguous part of the
+        directory starting at `cluster`."""
+        cluster = self.directory_cluster(cluster)
+        if cluster == 0:
+            yield self.first_root_dir_sector, self.n_root_dir_sectors
+            return
+        for first, length in self.table.runs(cluster):
+            yield (
+                self.first_sector_of_cluster(first),
+                length * self.bpb.n_sectors_per_cluster,
+            )
 
-        return self.scan_for_free_location_in_cluster(next_cluster)
+    def prefetch_directory(self, cluster):
+        for first_sector, n_sectors in self.directory_extents(cluster):
+            self.sectors.prefetch(first_sector, n_sectors)
+
+    def scandir(self, dp: DirectoryDescriptor):
+        """Yield a FileInfo for every entry of the directory, lazily.
+
+        Free, deleted and dot slots are skipped on their first byte without
+        decoding them.
+        """
+        long_name = LongName()
+        for first_sector, n_sectors in self.directory_extents(dp.cluster):
+            view = self.read_sectors(first_sector, n_sectors)
+            for offset in range(0, len(view), N_FAT_ENTRY):
+                first = view[offset]
+                if first == 0 or first == DELETED_ENTRY:
+                    long_name.reset()
+                    continue
+                if view[offset + 11] == DirectoryAttr.ATTR_LONG_NAME:
+                    long_name.add(LfnEntry(view, offset))
+                    continue
+                if first == ord("."):
+                    long_name.reset()
+                    continue
+                entry = FatEntry(view, offset)
+                name = long_name.take(entry.name)
+                if entry.attr & DirectoryAttr.ATTR_VOLUME_ID:
+                    continue
+                yield FileInfo(
+                    entry.file_size,
+                    name or entry_name(entry),
+                    entry.creation_date,
+                    entry.creation_time,
+                    entry.attr,
+                    entry_cluster(entry),
+                )
 
-    def create_file_or_directory(self, dp: DirectoryDescriptor, name, attr):
-        free_cluster = self.scan_fat()
-        if free_cluster == END_OF_FILE:
-            return
+    def walk(self, path="/", breadth_first=False):
+        """Walk the tree under `path` like os.walk.
 
-        buffer = encode_entry(**entry(name, attr, free_cluster))
+        Yields (path, directories, files) with lists of FileInfo for one
+        directory at a time, depth-first unless `breadth_first` is set. The
+        clusters of the directories next in line are prefetched.
+        """
+        dp = self.follow_path(path)
+        pending = deque([(path.rstrip("/") or "/", dp.cluster)])
+        while pending:
+            path, cluster = pending.popleft() if breadth_first else pending.pop()
+            directories = []
+            files = []
+            dp = DirectoryDescriptor(
+                cluster, self.sector_of_directory(cluster), DirectoryAttr.ATTR_DIRECTORY
+            )
+            for info in self.scandir(dp):
+                if info.attr & DirectoryAttr.ATTR_DIRECTORY:
+                    directories.append(info)
+                else:
+                    files.append(info)
+            yield path, directories, files
+
+            prefix = "" if path == "/" else path
+            children = [(f"{prefix}/{info.name}", info.cluster) for info in directories]
+            if breadth_first:
+                pending.extend(children)
+                upcoming = islice(pending, PREFETCH_DIRECTORIES)
+            else:
+                pending.extend(reversed(children))
+                upcoming = islice(reversed(pending), PREFETCH_DIRECTORIES)
+            for _path, next_cluster in upcoming:
+                self.prefetch_directory(next_cluster)
+
+    def directory_index(self, cluster):
+        """Return {name: (sector_index, offset, cluster, attr)} of the
+        directory. Names are upper case, as FAT compares them case
+        insensitively, and an entry with a long name is found under both."""
+        index = self.dcache.get(cluster)
+        if index is None:
+            index = {}
+            entries = with_long_names(self.entries_in_directory(cluster))
+            for sector_index, offset, entry, long_name in entries:
+                if is_free(entry):
+                    continue
+                location = (sector_index, offset, entry_cluster(entry), entry.attr)
+                index[entry_name(entry).upper()] = location
+                if long_name is not None:
+                    index[long_name.upper()] = location
+            self.dcache.put(cluster, index)
+        return index
+
+    def lookup(self, cluster, name):
+        return self.directory_index(cluster).get(name.upper())
+
+    def invalidate(self, cluster, name=None):
+        if name is None:
+            self.dcache.pop(cluster)
+        else:
+            index = self.dcache.get(cluster)
+            if index is not None:
+                index.pop(name.upper(), None)
+        self.path_cache.clear()
 
-        self.write_fat(free_cluster, END_OF_FILE),
-        sector_index, offset = self.scan_for_free_location_in_cluster(dp.cluster)
-        self.write_sector(sector_index, offset, buffer)
+    def sector_of_directory(self, cluster):
+        cluster = self.directory_cluster(cluster)
+        if cluster == 0:
+            return self.first_root_dir_sector
+        return self.first_sector_of_cluster(cluster)
+
+    def is_free_slot(self, sector_index, offset):
+        return self.read_sector(sector_index)[offset] in (0, DELETED_ENTRY)
+
+    def take_free_slots(self, cluster, count):
+        """Return `count` consecutive slots freed by deletes in the directory,
+        None when none were recorded."""
+        runs = self.free_slots.get(cluster)
+        if not runs:
+            return None
+        for i in range(len(runs) - 1, -1, -1):
+            run = runs[i]
+            if len(run) < count:
+                continue
+            # The slots may have been taken by a scan since they were recorded
+            if not all(self.is_free_slot(*location) for location in run[:count]):
+                del runs[i]
+                continue
+            if len(run) == count:
+                del runs[i]
+            else:
+                runs[i] = run[count:]
+            return run[:count]
+        return None
+
+    def scan_for_free_location_in_cluster(self, cluster, count=1):
+        """Return the locations of `count` consecutive free slots of the
+        directory, growing it when it has no such run."""
+        # Slots freed by deletes are reused first, without a scan
+        run = self.take_free_slots(cluster, count)
+        if run is not None:
+            return run
+
+        # Slots before the last one handed out in a directory are in use or
+        # recorded as freed, so the scan resumes from there instead of from
+        # the first entry.
+        hint = self.slot_hints.get(cluster)
+        run = []
+        for first_sector, n_sectors in self.directory_extents(cluster):
+            start = 0
+            if hint is not None:
+                if not first_sector <= hint[0] < first_sector + n_sectors:
+                    continue
+                start = (hint[0] - first_sector) * self.bpb.n_bytes_per_sector + hint[1]
+                hint = None
+            view = self.read_sectors(first_sector, n_sectors)
+            for position in range(start, len(view), N_FAT_ENTRY):
+                # Only the first byte is needed to tell if the slot is free
+                if view[position] not in (0, DELETED_ENTRY):
+                    run = []
+                    continue
+                sector_index, offset = divmod(position, self.bpb.n_bytes_per_sector)
+                run.append((first_sector + sector_index, offset))
+                if len(run) == count:
+                    self.slot_hints[cluster] = run[-1]
+                    return run
+        if hint is not None:
+            # The hint is stale, the directory no longer contains it
+            del self.slot_hints[cluster]
+            return self.scan_for_free_location_in_cluster(cluster, count)
+
+        # The root directory of FAT 12/16 has a fixed size and can't grow.
+        if self.directory_cluster(cluster) == 0:
+            raise Exception("root directory is full")
+
+        # Otherwise, allocate clusters at the end of the directory chain, a
+        # run of free slots at its end continues into them
+        last_cluster = int(self.table.chain(self.directory_cluster(cluster))[-1])
+        while len(run) < count:
+            next_cluster = self.scan_fat()
+            if next_cluster == self.end_of_file:
+                raise Exception("no free clusters")
+            self.reset_cluster(next_cluster)
+            self.write_fat(last_cluster, next_cluster)
+            self.write_fat(next_cluster, self.end_of_file)
+            first_sector = self.first_sector_of_cluster(next_cluster)
+            for position in range(0, self.n_bytes_per_cluster, N_FAT_ENTRY):
+                sector_index, offset = divmod(position, self.bpb.n_bytes_per_sector)
+                run.append((first_sector + sector_index, offset))
+            last_cluster = next_cluster
+
+        run = run[:count]
+        self.slot_hints[cluster] = run[-1]
+        return run
+
+    @synchronized
+    def create_file_or_directory(
+        self, dp: DirectoryDescriptor, name, attr, n_clusters=1
+    ):
+        """Create the entry `name` in the directory.
+
+        A file whose size is known can get all its `n_clusters` up front, in
+        one contiguous run when possible, so its data isn't split around the
+        clusters of entries created in the meantime.
+        """
+        if name in ("", ".", ".."):
+            raise Exception(f"invalid name {name!r}")
+        index = self.directory_index(dp.cluster)
+        if name.upper() in index:
+            raise Exception("entry does already exist")
+        # Names that aren't valid 8.3 names are stored in long name slots
+        # in front of the entry, under a generated short name
+        short = to_short_name(name)
+        slots = []
+        if short is None:
+            short = generate_short_name(name, index)
+            slots = encode_long_name(name, short)
+
+        # The slots are found first, a full directory doesn't leak a cluster
+        locations = self.scan_for_free_location_in_cluster(dp.cluster, len(slots) + 1)
+        if n_clusters > self.table.n_free:
+            # The slots stay free, the next scan must not skip them
+            self.slot_hints.pop(dp.cluster, None)
+            raise Exception("no free clusters")
+        free_cluster = self.table.allocate(n_clusters, self.end_of_file)[0]
+
+        slots.append(encode_entry(**entry(short, attr, free_cluster)))
+        for (sector_index, offset), slot in zip(locations, slots):
+            self.write_sector(sector_index, offset, slot)
+        location = (sector_index, offset, free_cluster, attr)
+        index[short_name(short).upper()] = location
+        index[name.upper()] = location
 
         if attr & DirectoryAttr.ATTR_DIRECTORY:
             self.reset_cluster(free_cluster)
             sector_index = self.first_sector_of_cluster(free_cluster)
             this_dir = encode_entry(
                 **entry(
-                    ".",
+                    to_short_name("."),
                     DirectoryAttr.ATTR_DIRECTORY | DirectoryAttr.ATTR_HIDDEN,
                     free_cluster,
                 )
             )
             parent_dir = encode_entry(
                 **entry(
-                    "..",
+                    to_short_name(".."),
                     DirectoryAttr.ATTR_DIRECTORY | DirectoryAttr.ATTR_HIDDEN,
                     dp.cluster,
                 )
@@ -226,7 +577,14 @@ class Fat:
 
             return DirectoryDescriptor(free_cluster, sector_index, attr)
         else:
-            return FileDescriptor(free_cluster, sector_index, attr, dp.sector, 0)
+            return FileDescriptor(
+                free_cluster,
+                self.first_sector_of_cluster(free_cluster),
+                attr,
+                location[0],
+                0,
+                location[1],
+            )
 
     def create_file(self, directory, name, attr=DirectoryAttr.ATTR_ARCHIVE):
         self.create_file_or_directory(directory, name, attr)
@@ -234,36 +592,39 @@ class Fat:
     def follow_path(self, path: str):
         # Check for absolute path.
         if path.startswith("/"):
-            dp = DirectoryDescriptor(0, 0, 0)
+            cluster, attr = 0, DirectoryAttr.ATTR_DIRECTORY
         else:
-            dp = DirectoryDescriptor(self.cwd.cluster, self.cwd.sector, self.cwd.attr)
-
-        if path == "":
-            return dp
-
-        names = path.split("/")
-
-        for name in names:
-            found = False
-            for _sector_index, _offset, entry in self.entries_in_cluster(dp.cluster):
-                if name in entry.name:
-                    if (entry.attr & DirectoryAttr.ATTR_DIRECTORY) == 0:
-                        raise Exception("entry is not directory")
-                    dp.cluster = entry.first_cluster_lo
-                    dp.sector = self.first_sector_of_cluster(entry.first_cluster_lo)
-                    dp.attr = entry.attr
-                    found = True
-                    break
-
-            if not found:
+            cluster, attr = self.cwd.cluster, self.cwd.attr
+
+        names = [name for name in path.split("/") if name not in ("", ".")]
+        start = cluster
+        for i in range(len(names), 0, -1):
+            cached = self.path_cache.get((start, "/".join(names[:i])))
+            if cached is not None:
+                cluster, attr = cached
+                break
+        else:
+            i = 0
+
+        for j in range(i, len(names)):
+            found = self.lookup(cluster, names[j])
+            if found is None:
+                # There are no dot entries in the root directory.
+                if cluster == 0 and names[j] == "..":
+                    continue
                 raise Exception("can't find path")
+            _sector_index, _offset, cluster, attr = found
+            if (attr & DirectoryAttr.ATTR_DIRECTORY) == 0:
+                raise Exception("entry is not directory")
+            self.path_cache.put((start, "/".join(names[: j + 1])), (cluster, attr))
 
-        return dp
+        return DirectoryDescriptor(cluster, self.sector_of_directory(cluster), attr)
 
     def chdir(self, path):
         dp = self.follow_path(path)
         self.cwd = dp
 
+    @synchronized
     def f_opendir(self, path: str) -> DirectoryDescriptor:
         if path == "/":
             raise Exception("directory does already exist")
@@ -279,67 +640,355 @@ class Fat:
 
     def f_readdir(self, dp: DirectoryDescriptor) -> list[FileInfo]:
         buffer = []
-        for _sector_index, _offset, entry in self.entries_in_cluster(dp.cluster):
-            if entry.attr != 0:
+        entries = with_long_names(self.entries_in_directory(dp.cluster))
+        for _sector_index, _offset, entry, long_name in entries:
+            if not is_free(entry):
                 file_info = FileInfo(
                     entry.file_size,
-                    entry.name,
+                    long_name or entry_name(entry),
                     entry.creation_date,
                     entry.creation_time,
                     entry.attr,
+                    entry_cluster(entry),
                 )
                 buffer.append(file_info)
 
         return buffer
 
-    def f_open(self, path) -> FileDescriptor:
+    @synchronized
+    def f_open(self, path) -> FileHandle:
         if path == "/":
             raise Exception("directory does already exist")
         prefix = "/" if path.startswith("/") else ""
         [*base, name] = path.split("/")
         parent_path = prefix + "/".join(base)
         dp = self.follow_path(parent_path)
-        for _sector_index, _offset, entry in self.entries_in_cluster(dp.cluster):
-            if name in entry.name:
-                if (entry.attr & DirectoryAttr.ATTR_ARCHIVE) == 0:
-                    raise Exception("entry is not file")
-                sector = self.first_sector_of_cluster(entry.first_cluster_lo)
-                return FileDescriptor(
-                    entry.first_cluster_lo,
-                    sector,
-                    entry.attr,
-                    dp.sector,
-                    entry.file_size,
-                )
-
-        attr = DirectoryAttr.ATTR_ARCHIVE
-        return self.create_file_or_directory(dp, name, attr)
+        found = self.lookup(dp.cluster, name)
+        if found is not None:
+            sector_index, offset, cluster, attr = found
+            if attr & DirectoryAttr.ATTR_DIRECTORY:
+                raise Exception("entry is not file")
+            entry = FatEntry(self.read_sector(sector_index), offset)
+            fp = FileDescriptor(
+                cluster,
+                self.first_sector_of_cluster(cluster),
+                attr,
+                sector_index,
+                entry.file_size,
+                offset,
+            )
+        else:
+            attr = DirectoryAttr.ATTR_ARCHIVE
+            fp = self.create_file_or_directory(dp, name, attr)
+        handle = FileHandle(self, fp)
+        location = (handle.dir_sector, handle.dir_offset)
+        self.open_files.setdefault(location, weakref.WeakSet()).add(handle)
+        return handle
 
     def f_close(self, fp: FileDescriptor):
-        pass
+        if isinstance(fp, FileHandle):
+            fp.close()
+
+    def extents(self, fp: FileDescriptor, offset=0, length=None):
+        """Yield zero-copy views covering `length` bytes of the file from
+        `offset`, one per run of consecutive clusters in its chain."""
+        end = fp.size if length is None else min(fp.size, offset + length)
+        position = 0
+        for first, n_clusters in self.table.runs(fp.cluster):
+            if position >= end:
+                break
+            run_end = position + n_clusters * self.n_bytes_per_cluster
+            if run_end > offset:
+                view = self.read_sectors(
+                    self.first_sector_of_cluster(first),
+                    n_clusters * self.bpb.n_sectors_per_cluster,
+                )
+                yield view[max(offset - position, 0) : min(end, run_end) - position]
+            position = run_end
+
+    def f_pread(self, fp: FileDescriptor, offset=0, length=None) -> bytes:
+        return b"".join(self.extents(fp, offset, length))
+
+    def f_readinto(self, fp: FileDescriptor, buffer, offset=0) -> int:
+        buffer = memoryview(buffer).cast("B")
+        n = 0
+        for view in self.extents(fp, offset, len(buffer)):
+            buffer[n : n + len(view)] = view
+            n += len(view)
+        return n
+
+    def f_iter(self, fp: FileDescriptor, chunk_size=None, offset=0):
+        chunk_size = chunk_size or self.n_bytes_per_cluster
+        for view in self.extents(fp, offset):
+            for i in range(0, len(view), chunk_size):
+                yield view[i : i + chunk_size]
 
     def f_read(self, fp: FileDescriptor) -> str:
-        content = [0] * fp.size
-        i = 0
-        for i in range(fp.size):
-            sector = self.sectors[fp.sector + i // self.bpb.n_bytes_per_sector]
-            content[i] = chr(sector[i % self.bpb.n_bytes_per_sector])
-        return "".join(content)
-
-    def f_write(self, fp: FileDescriptor):
-        pass
+        return self.f_pread(fp).decode("latin-1")
+
+    @synchronized
+    def f_write(self, fp: FileDescriptor, buffer, offset=None) -> int:
+        """Write `buffer` at `offset`, appending when no offset is given."""
+        if fp.dir_sector is None:
+            raise Exception("file was removed")
+        buffer = memoryview(buffer).cast("B")
+        n_written = len(buffer)
+        if offset is None:
+            offset = fp.size
+        if offset > fp.size:
+            # Fill the hole between the current end of file and the offset
+            buffer = memoryview(bytes(offset - fp.size) + buffer)
+            offset = fp.size
+        end = offset + len(buffer)
+
+        runs = self.table.runs(fp.cluster)
+        n_clusters = sum(length for _first, length in runs)
+        needed = -(-end // self.n_bytes_per_cluster) - n_clusters
+        if needed > 0:
+            last = runs[-1][0] + runs[-1][1] - 1 if runs else None
+            clusters = self.table.allocate(needed, self.end_of_file, after=last)
+            if not runs:
+                fp.cluster = clusters[0]
+                fp.sector = self.first_sector_of_cluster(fp.cluster)
+            runs = self.table.runs(fp.cluster)
+
+        position = 0
+        for first, length in runs:
+            run_end = position + length * self.n_bytes_per_cluster
+            if run_end > offset:
+                start = max(offset - position, 0)
+                stop = min(end, run_end) - position
+                self.write_sectors(
+                    self.first_sector_of_cluster(first),
+                    start,
+                    buffer[position + start - offset : position + stop - offset],
+                )
+            position = run_end
+            if position >= end:
+                break
+
+        if end > fp.size or needed > 0:
+            fp.size = max(fp.size, end)
+            entry = FatEntry(self.read_sector(fp.dir_sector), fp.dir_offset)
+            entry.file_size = fp.size
+            entry.first_cluster_lo = fp.cluster & 0xFFFF
+            entry.first_cluster_hi = fp.cluster >> 16
+            self.write_sector(fp.dir_sector, fp.dir_offset, entry.to_bytes())
+        return n_written
 
     def f_size(self, fp: FileDescriptor):
-        pass
+        return fp.size
 
+    def split_path(self, path):
+        """Return the descriptor of the parent directory of `path` and the
+        last name of `path`."""
+        prefix = "/" if path.startswith("/") else ""
+        [*base, name] = path.rstrip("/").split("/")
+        return self.follow_path(prefix + "/".join(base)), name
+
+    def find_entry(self, path):
+        """Return the parent directory descriptor, the name and the
+        (sector_index, offset, cluster, attr) location of the entry `path`."""
+        dp, name = self.split_path(path)
+        if name in ("", ".", ".."):
+            raise Exception(f"invalid name {name!r}")
+        found = self.lookup(dp.cluster, name)
+        if found is None:
+            raise Exception("can't find path")
+        return dp, name, found
+
+    def previous_slot(self, extents, sector_index, offset):
+        """Return the location of the slot before the given one in the
+        directory made of `extents`, None for the first slot."""
+        if offset > 0:
+            return sector_index, offset - N_FAT_ENTRY
+        for i, (first_sector, n_sectors) in enumerate(extents):
+            if first_sector <= sector_index < first_sector + n_sectors:
+                if sector_index > first_sector:
+                    return sector_index - 1, self.bpb.n_bytes_per_sector - N_FAT_ENTRY
+                if i == 0:
+                    return None
+                first_sector, n_sectors = extents[i - 1]
+                return (
+                    first_sector + n_sectors - 1,
+                    self.bpb.n_bytes_per_sector - N_FAT_ENTRY,
+                )
+        return None
+
+    def entry_slots(self, cluster, sector_index, offset):
+        """Return the locations of the slots of the entry at `sector_index`
+        and `offset`, its long name slots first, and its long name or None.
+
+        Long name slots are found walking back from the short entry, so it
+        costs a few slots, not a scan of the directory.
+        """
+        entry = FatEntry(self.read_sector(sector_index), offset)
+        value = checksum(entry.name.encode("latin-1"))
+        extents = list(self.directory_extents(cluster))
+        locations = [(sector_index, offset)]
+        parts = []
+        while True:
+            location = self.previous_slot(extents, *locations[0])
+            if location is None:
+                break
+            buffer = self.read_sector(location[0]).bytes
+            if buffer[location[1] + 11] != DirectoryAttr.ATTR_LONG_NAME:
+                break
+            part = LfnEntry(buffer, location[1])
+            if part.checksum != value or part.order & ORDER_MASK != len(parts) + 1:
+                break
+            locations.insert(0, location)
+            parts.insert(0, part)
+            if part.order & LAST_LONG_ENTRY:
+                break
+        long_name = LongName()
+        for part in parts:
+            long_name.add(part)
+        return locations, long_name.take(entry.name)
+
+    def free_entry_slots(self, cluster, locations):
+        """Mark the slots deleted and record them for reuse."""
+        for sector_index, offset in locations:
+            self.write_sector(sector_index, offset, bytes([DELETED_ENTRY]))
+        self.free_slots.setdefault(cluster, []).append(locations)
+
+    def forget(self, cluster, entry, long_name):
+        """Drop both names of `entry` from the cached index of `cluster`."""
+        index = self.directory_index(cluster)
+        index.pop(entry_name(entry).upper(), None)
+        if long_name is not None:
+            index.pop(long_name.upper(), None)
+        self.path_cache.clear()
+
+    def move_open_files(self, old, new):
+        """Point the handles open on the short entry at `old` to `new`, None
+        when the entry was removed."""
+        for fp in self.open_files.pop(old, ()):
+            fp.dir_sector, fp.dir_offset = new or (None, 0)
+            if new is not None:
+                self.open_files.setdefault(new, weakref.WeakSet()).add(fp)
+
+    def write_entry(self, dp: DirectoryDescriptor, name, entry: FatEntry, locations):
+        """Store `entry` under `name` in the directory, in the slots at
+        `locations` when given and long enough, and index it."""
+        index = self.directory_index(dp.cluster)
+        short = to_short_name(name)
+        slots = []
+        if short is None:
+            short = generate_short_name(name, index)
+            slots = encode_long_name(name, short)
+        entry.name = short
+        slots.append(entry.to_bytes())
+
+        if locations is not None and len(locations) >= len(slots):
+            # The name fits in the former slots, its short entry stays where it was
+            unused = locations[: len(locations) - len(slots)]
+            locations = locations[len(unused) :]
+            if unused:
+                self.free_entry_slots(dp.cluster, unused)
+        else:
+            if locations is not None:
+                self.free_entry_slots(dp.cluster, locations)
+            locations = self.scan_for_free_location_in_cluster(dp.cluster, len(slots))
+        for (sector_index, offset), slot in zip(locations, slots):
+            self.write_sector(sector_index, offset, slot)
+        location = (sector_index, offset, entry_cluster(entry), entry.attr)
+        index[short_name(short).upper()] = location
+        index[name.upper()] = location
+        return location
+
+    @synchronized
     def f_unlink(self, path):
         """Remove file or sub-directory."""
-        pass
-
+        dp, _name, (sector_index, offset, cluster, attr) = self.find_entry(path)
+        if attr & DirectoryAttr.ATTR_DIRECTORY:
+            child = DirectoryDescriptor(
+                cluster, self.sector_of_directory(cluster), attr
+            )
+            if next(self.scandir(child), None) is not None:
+                raise Exception("directory is not empty")
+            if cluster == self.cwd.cluster:
+                raise Exception("directory is the current directory")
+            self.dcache.pop(cluster)
+            self.slot_hints.pop(cluster, None)
+            self.free_slots.pop(cluster, None)
+
+        entry = FatEntry(self.read_sector(sector_index), offset)
+        locations, long_name = self.entry_slots(dp.cluster, sector_index, offset)
+        self.free_entry_slots(dp.cluster, locations)
+        self.forget(dp.cluster, entry, long_name)
+        self.move_open_files((sector_index, offset), None)
+        if cluster != 0:
+            self.table.release(self.table.chain(cluster))
+
+    @synchronized
     def f_rename(self, old_path, new_path):
-        """Rename or move file or sub-directory."""
-        pass
+        """Rename or move file or sub-directory.
+
+        Only directory entries change, the data clusters are left as they are.
+        """
+        old_dp, _old_name, found = self.find_entry(old_path)
+        sector_index, offset, cluster, attr = found
+        new_dp, new_name = self.split_path(new_path)
+        if new_name in ("", ".", ".."):
+            raise Exception(f"invalid name {new_name!r}")
+        existing = self.lookup(new_dp.cluster, new_name)
+        if existing is not None and existing != found:
+            raise Exception("entry does already exist")
+
+        is_directory = attr & DirectoryAttr.ATTR_DIRECTORY
+        if is_directory and new_dp.cluster != old_dp.cluster:
+            # A directory can't move below itself
+            ancestor = new_dp.cluster
+            while ancestor != 0:
+                if ancestor == cluster:
+                    raise Exception("can't move a directory into itself")
+                parent = self.lookup(ancestor, "..")
+                if parent is None:
+                    break
+                ancestor = parent[2]
 
+        entry = FatEntry(self.read_sector(sector_index), offset)
+        locations, long_name = self.entry_slots(old_dp.cluster, sector_index, offset)
+        self.forget(old_dp.cluster, entry, long_name)
+        if new_dp.cluster == old_dp.cluster:
+            location = self.write_entry(new_dp, new_name, entry, locations)
+        else:
+            self.free_entry_slots(old_dp.cluster, locations)
+            location = self.write_entry(new_dp, new_name, entry, None)
+        # A longer name or another directory may move the short entry
+        self.move_open_files((sector_index, offset), location[:2])
+
+        if is_directory and new_dp.cluster != old_dp.cluster:
+            # Its ".." entry follows it to the new parent
+            found = self.lookup(cluster, "..")
+            if found is not None:
+                parent = FatEntry(self.read_sector(found[0]), found[1])
+                parent.first_cluster_lo = new_dp.cluster & 0xFFFF
+                parent.first_cluster_hi = new_dp.cluster >> 16
+                self.write_sector(found[0], found[1], parent.to_bytes())
+                self.directory_index(cluster)[".."] = (
+                    found[0],
+                    found[1],
+                    new_dp.cluster,
+                    found[3],
+                )
+
+    @synchronized
     def f_chmod(self, path, attr, mask):
         """Change attribute of file or sub-directory."""
-        pass
+        dp, _name, (sector_index, offset, cluster, old_attr) = self.find_entry(path)
+        mask &= (
+            DirectoryAttr.ATTR_READ_ONLY
+            | DirectoryAttr.ATTR_HIDDEN
+            | DirectoryAttr.ATTR_SYSTEM
+            | DirectoryAttr.ATTR_ARCHIVE
+        )
+        entry = FatEntry(self.read_sector(sector_index), offset)
+        entry.attr = (old_attr & ~mask) | (attr & mask)
+        self.write_sector(sector_index, offset, entry.to_bytes())
+        location = (sector_index, offset, cluster, entry.attr)
+        index = self.directory_index(dp.cluster)
+        for key, value in index.items():
+            if value[:2] == (sector_index, offset):
+                index[key] = location
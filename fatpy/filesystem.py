@@ -1,44 +1,231 @@
-import struct
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 
+from cache import BlockCache
+from device import BlockDevice
 from fat import Fat
-from util import SECTOR_LENGTH, Mbr, Partition, Sector
+from instrument import TABLE_COUNTERS, Profiler
+from journal import CHECKPOINT_SIZE, JOURNAL_SUFFIX, Journal
+from overlay import OverlayDevice
+from util import SECTOR_LENGTH, Mbr, Partition
 
 
 class FileSystem:
-    def __init__(self, device: str):
-        self.sectors = self.read_disk(device)
+    def __init__(
+        self,
+        device: str,
+        writable=False,
+        profile=False,
+        journal=False,
+        overlay=False,
+        delta=None,
+    ):
+        self.profiler = Profiler() if profile else None
+        start = time.perf_counter()
+        # In overlay mode the image is only read and writes go to the delta
+        self.overlay = overlay or delta is not None
+        if self.overlay and journal:
+            raise Exception("an overlay can't be journaled")
+        if journal and not writable:
+            raise Exception("a journal needs a writable mount")
+        self.delta = delta
+        self.sectors = BlockCache(self.read_disk(device, writable))
+        self.writable = writable or self.overlay
+        # A journal left behind is replayed even when journaling is off
+        self.journal = None
+        if (
+            isinstance(device, str)
+            and not self.overlay
+            and (journal or os.path.exists(device + JOURNAL_SUFFIX))
+        ):
+            self.journal = Journal(device + JOURNAL_SUFFIX, self.sectors.sector_length)
+            self.replay()
+            if not journal:
+                self.journal.close()
+                self.journal = None
+        self.mount()
+
+        self.current_dir = "/"
+        # Transaction depth per thread, a transaction open on one thread
+        # must not keep the outermost one of another from syncing
+        self.transactions = threading.local()
+        # Group commit, every commit started after a caller's operations
+        # finished covers them
+        self.commit_condition = threading.Condition()
+        self.committing = False
+        self.started = 0
+        self.finished = 0
+        if self.profiler:
+            self.profiler.record("FileSystem.mount", time.perf_counter() - start)
+            self.profiler.instrument(self, ["sync"])
+
+    def mount(self):
         self.mbr = Mbr.parse(self.sectors[0])
-        self.fat = {
-            i: Fat(self.sectors, self.mbr.partitions[i])
+        partitions = {
+            i: self.mbr.partitions[i]
             for i in range(len(self.mbr.partitions))
             if self.mbr.partitions[i].sector != 0
         }
+        # Every partition parses its BPB and loads its FAT independently
+        self.fat = self.run_parallel(
+            lambda partition: Fat(self.sectors, partition), partitions
+        )
         if len(self.fat) == 0:
-            partition = Partition([0] * 16)
+            partition = Partition(bytes(16))
             partition.sector = 0
             partition.size = len(self.sectors) * SECTOR_LENGTH
             self.fat[0] = Fat(self.sectors, partition)
+        if self.profiler:
+            for fat in self.fat.values():
+                self.profiler.instrument(fat)
+                self.profiler.instrument(fat.table, TABLE_COUNTERS)
 
-        self.current_dir = "/"
+    @staticmethod
+    def run_parallel(function, items):
+        if len(items) <= 1:
+            return {i: function(items[i]) for i in items}
+        with ThreadPoolExecutor(max_workers=len(items)) as pool:
+            futures = {i: pool.submit(function, items[i]) for i in items}
+            return {i: futures[i].result() for i in futures}
+
+    def map(self, function):
+        """Run `function(fat)` for every partition concurrently.
+
+        Returns the results keyed by partition index.
+        """
+        return self.run_parallel(function, self.fat)
+
+    def read_disk(self, device: str, writable=False) -> BlockDevice:
+        if self.overlay:
+            return OverlayDevice(device, self.delta)
+        return BlockDevice(device, writable)
+
+    def replay(self):
+        """Apply the transactions committed to the journal but possibly not
+        to the image. Without write access they are only applied in memory."""
+        for runs in self.journal.transactions():
+            self.sectors.apply(runs)
+        if self.writable:
+            self.sectors.flush()
+            self.sectors.fsync()
+            self.journal.checkpoint()
+
+    def sync(self):
+        """Write the sectors modified since the last sync back to the image.
+
+        With a journal the modifications are committed to it first, and
+        concurrent calls share a single journal write and fsync.
+        """
+        if self.journal is None:
+            for fat in self.fat.values():
+                fat.write_fsinfo()
+            self.sectors.flush()
+            return
+
+        with self.commit_condition:
+            ticket = self.started + 1
+            while self.finished < ticket:
+                if not self.committing:
+                    self.committing = True
+                    self.started += 1
+                    break
+                self.commit_condition.wait()
+            else:
+                return
+        try:
+            self.commit()
+        finally:
+            with self.commit_condition:
+                self.finished = self.started
+                self.committing = False
+                self.commit_condition.notify_all()
+
+    def commit(self):
+        # Operations hold their partition's lock, so with every lock taken
+        # the copy holds whole operations only
+        with self.quiesce():
+            for fat in self.fat.values():
+                fat.write_fsinfo()
+            runs = self.sectors.capture()
+        if not runs:
+            return
+        self.journal.append(runs)
+        self.sectors.write_runs(runs)
+        if self.journal.size > CHECKPOINT_SIZE:
+            self.sectors.fsync()
+            self.journal.checkpoint()
+
+    @contextmanager
+    def quiesce(self):
+        """Hold every partition lock, no operation is half done inside."""
+        with ExitStack() as stack:
+            for fat in self.fat.values():
+                stack.enter_context(fat.lock)
+            yield
+
+    def snapshot(self, name):
+        """Remember the state of an overlay under `name`, at the cost of a
+        copy of the sectors modified so far."""
+        if not self.overlay:
+            raise Exception("file system is not an overlay")
+        with self.quiesce():
+            for fat in self.fat.values():
+                fat.write_fsinfo()
+            self.sectors.snapshot(name)
+
+    def restore(self, name):
+        """Return an overlay to the snapshot `name` and mount it again."""
+        if not self.overlay:
+            raise Exception("file system is not an overlay")
+        if name not in self.sectors.snapshots:
+            raise Exception(f"no snapshot named {name}")
+        with self.quiesce():
+            self.sectors.restore(name)
+        self.mount()
+
+    def commit_overlay(self):
+        """Write the modifications of an overlay into its base image."""
+        if not self.overlay:
+            raise Exception("file system is not an overlay")
+        with self.quiesce():
+            for fat in self.fat.values():
+                fat.write_fsinfo()
+            self.sectors.commit()
+
+    def checkpoint(self):
+        """Sync, make the image itself durable and empty the journal."""
+        self.sync()
+        with self.commit_condition:
+            while self.committing:
+                self.commit_condition.wait()
+            self.sectors.fsync()
+            if self.journal is not None:
+                self.journal.checkpoint()
+
+    @contextmanager
+    def transaction(self):
+        """Group the operations run inside into one write back.
+
+        Transactions nest, the dirty sectors are flushed once when the
+        outermost one of the thread exits.
+        """
+        depth = getattr(self.transactions, "depth", 0)
+        self.transactions.depth = depth + 1
+        try:
+            yield self
+        finally:
+            self.transactions.depth = depth
+            if depth == 0 and self.writable:
+                self.sync()
 
-    def read_disk(self, device: str) -> list[Sector]:
-        sectors = []
-
-        with open(device, mode="rb") as f:
-            content = f.read()
-            i = 0
-            while i < len(content):
-                buffer = content[i : i + SECTOR_LENGTH]
-                unpacked = struct.unpack(f"{SECTOR_LENGTH}B", buffer)
-                sectors.append(Sector(unpacked))
-                i += SECTOR_LENGTH
-        return sectors
-
-    def write_disk(self, device: str):
-        with open(device, mode="wb") as f:
-            for sector in self.sectors:
-                bytes = struct.pack(f"{SECTOR_LENGTH}B", *sector.bytes)
-                f.write(bytes)
+    def stats(self):
+        stats = self.sectors.stats()
+        if self.profiler:
+            stats.update(self.profiler.stats())
+        return stats
 
     def chdir(self):
         pass
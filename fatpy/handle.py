@@ -0,0 +1,90 @@
+import io
+
+from util import FileDescriptor
+
+READ_AHEAD_CLUSTERS = 8
+WRITE_BEHIND_CLUSTERS = 8
+
+
+class FileHandle(io.RawIOBase, FileDescriptor):
+    """Open file returned by Fat.f_open.
+
+    The handle is still a FileDescriptor, so it can be passed to every Fat
+    file function. On top of that it keeps a position, reads ahead a window
+    of clusters along the chain and defers writes until the buffer fills up,
+    the handle is flushed or it is closed with Fat.f_close.
+    """
+
+    def __init__(self, fat, fp: FileDescriptor):
+        io.RawIOBase.__init__(self)
+        FileDescriptor.__init__(
+            self, fp.cluster, fp.sector, fp.attr, fp.dir_sector, fp.size, fp.dir_offset
+        )
+        self.fat = fat
+        self.position = 0
+        self.read_ahead = READ_AHEAD_CLUSTERS * fat.n_bytes_per_cluster
+        self.write_behind = WRITE_BEHIND_CLUSTERS * fat.n_bytes_per_cluster
+        self.read_buffer = b""
+        self.read_offset = 0
+        self.write_buffer = bytearray()
+        self.write_offset = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def logical_size(self):
+        return max(self.size, self.write_offset + len(self.write_buffer))
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.logical_size()
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        self.flush()
+        buffer = memoryview(buffer).cast("B")
+        end = self.read_offset + len(self.read_buffer)
+        if not self.read_offset <= self.position < end:
+            length = max(len(buffer), self.read_ahead)
+            self.read_buffer = self.fat.f_pread(self, self.position, length)
+            self.read_offset = self.position
+            end = self.read_offset + len(self.read_buffer)
+
+        start = self.position - self.read_offset
+        n = min(len(buffer), end - self.position)
+        buffer[:n] = self.read_buffer[start : start + n]
+        self.position += n
+        return n
+
+    def write(self, buffer):
+        buffer = memoryview(buffer).cast("B")
+        if self.position != self.write_offset + len(self.write_buffer):
+            self.flush()
+            self.write_offset = self.position
+        self.write_buffer += buffer
+        self.position += len(buffer)
+        self.read_buffer = b""
+        if len(self.write_buffer) >= self.write_behind:
+            self.flush()
+        return len(buffer)
+
+    def flush(self):
+        if self.write_buffer:
+            self.fat.f_write(self, self.write_buffer, self.write_offset)
+            self.write_offset += len(self.write_buffer)
+            self.write_buffer = bytearray()
+        super().flush()
@@ -0,0 +1,110 @@
+import functools
+import inspect
+import threading
+import time
+from collections import defaultdict
+
+# Low level operations that are counted and timed
+COUNTERS = [
+    "read_sector",
+    "read_sectors",
+    "write_sector",
+    "write_sectors",
+    "read_fat",
+    "write_fat",
+    "scan_fat",
+    "entries_in_cluster",
+]
+
+# Cluster table operations, most FAT traffic bypasses read_fat and write_fat
+TABLE_COUNTERS = [
+    "chain",
+    "runs",
+    "allocate",
+    "release",
+    "find_free",
+]
+
+# Operations that are timed as a whole, including the calls they make
+SPANS = [
+    "follow_path",
+    "create_file_or_directory",
+    "f_open",
+    "f_opendir",
+    "f_readdir",
+    "f_read",
+    "f_pread",
+    "f_write",
+    "f_unlink",
+    "f_rename",
+    "f_chmod",
+    "scandir",
+    "walk",
+]
+
+
+class Profiler:
+    """Call counts and cumulative time per operation.
+
+    Instrumenting replaces methods on the given instance only, objects that
+    are not instrumented run the plain methods and pay nothing.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        with self.lock:
+            self.calls[name] += 1
+            self.seconds[name] += elapsed
+
+    def wrap(self, name, method):
+        if inspect.isgeneratorfunction(method):
+            # Time spent producing items, not the time the consumer holds them
+            @functools.wraps(method)
+            def generator(*args, **kwargs):
+                elapsed = 0.0
+                iterator = method(*args, **kwargs)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    self.record(name, elapsed)
+
+            return generator
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        return wrapper
+
+    def instrument(self, obj, names=COUNTERS + SPANS):
+        prefix = obj.__class__.__name__
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is not None:
+                setattr(obj, name, self.wrap(f"{prefix}.{name}", method))
+
+    def stats(self):
+        return {
+            name: f"{self.calls[name]} calls, {self.seconds[name]:.6f}s"
+            for name in sorted(self.calls, key=self.seconds.get, reverse=True)
+        }
+
+    def report(self):
+        stats = self.stats()
+        return "\n".join(f"{name}: {stats[name]}" for name in stats)
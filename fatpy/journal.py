@@ -0,0 +1,98 @@
+import os
+import struct
+import zlib
+
+from util import SECTOR_LENGTH
+
+JOURNAL_SUFFIX = ".journal"
+# Past this size the next commit checkpoints the image and empties the journal
+CHECKPOINT_SIZE = 64 * 1024 * 1024
+TRANSACTION_MAGIC = b"FJTX"
+COMMIT_MAGIC = b"FJCM"
+# magic, sequence number, number of runs
+TRANSACTION = struct.Struct("<4sQI")
+# first sector, sector count, followed by the sectors
+RUN = struct.Struct("<QI")
+# magic, sequence number, crc32 of the transaction up to the commit record
+COMMIT = struct.Struct("<4sQI")
+
+
+class Journal:
+    """Redo log of sector writes kept in a file next to the image.
+
+    A transaction holds the new contents of every sector it modifies and ends
+    with a commit record. It is appended and fsynced before any of its
+    sectors reach the image, so the image never needs undoing: after a crash
+    the committed transactions are written again and a torn one is ignored.
+    """
+
+    def __init__(self, path, sector_length=SECTOR_LENGTH):
+        self.path = path
+        self.sector_length = sector_length
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.sequence = 0
+
+    def encode(self, runs):
+        header = TRANSACTION.pack(TRANSACTION_MAGIC, self.sequence, len(runs))
+        parts = [header]
+        for index, data in runs:
+            parts.append(RUN.pack(index, len(data) // self.sector_length))
+            parts.append(data)
+        crc = 0
+        for part in parts:
+            crc = zlib.crc32(part, crc)
+        parts.append(COMMIT.pack(COMMIT_MAGIC, self.sequence, crc))
+        return parts
+
+    def append(self, runs):
+        """Durably append one transaction of (first sector, data) runs."""
+        record = memoryview(b"".join(self.encode(runs)))
+        while record:
+            n = os.pwrite(self.fd, record, self.size)
+            self.size += n
+            record = record[n:]
+        os.fsync(self.fd)
+        self.sequence += 1
+
+    def transactions(self):
+        """Yield the runs of every complete transaction, in commit order."""
+        data = memoryview(os.pread(self.fd, self.size, 0))
+        position = 0
+        while position + TRANSACTION.size <= len(data):
+            magic, sequence, n_runs = TRANSACTION.unpack_from(data, position)
+            if magic != TRANSACTION_MAGIC:
+                return
+            end = position + TRANSACTION.size
+            runs = []
+            for _ in range(n_runs):
+                if end + RUN.size > len(data):
+                    return
+                index, count = RUN.unpack_from(data, end)
+                end += RUN.size
+                length = count * self.sector_length
+                if end + length > len(data):
+                    return
+                runs.append((index, data[end : end + length]))
+                end += length
+            if end + COMMIT.size > len(data):
+                return
+            magic, commit_sequence, crc = COMMIT.unpack_from(data, end)
+            if (
+                magic != COMMIT_MAGIC
+                or commit_sequence != sequence
+                or crc != zlib.crc32(data[position:end])
+            ):
+                return
+            yield runs
+            position = end + COMMIT.size
+
+    def checkpoint(self):
+        """Empty the journal, once the image holds all it contains."""
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        self.size = 0
+        self.sequence = 0
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,187 @@
+import itertools
+import zlib
+
+from util import DirectoryAttr, LfnEntry
+
+LFN_CHARACTERS = 13
+LAST_LONG_ENTRY = 0x40
+ORDER_MASK = 0x3F
+MAX_LONG_ENTRIES = 20
+MAX_NAME_LENGTH = 255
+SHORT_NAME_CHARACTERS = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~"
+)
+
+
+def checksum(short_name: bytes):
+    """Checksum of the 11 byte short name stored in each of its long name slots."""
+    value = 0
+    for byte in short_name:
+        value = (((value & 1) << 7) + (value >> 1) + byte) & 0xFF
+    return value
+
+
+def short_name(raw: str):
+    """Display form of an 11 character short name, "NAME    EXT" -> "NAME.EXT"."""
+    if raw[0] == "\x05":
+        # 0xE5 is a valid first character, stored as 0x05 as it marks deleted slots
+        raw = "\xe5" + raw[1:]
+    base = raw[:8].rstrip("\x00 ")
+    extension = raw[8:11].rstrip("\x00 ")
+    return f"{base}.{extension}" if extension else base
+
+
+def to_short_name(name: str):
+    """Return the 11 character short name for `name` when it is a valid 8.3
+    name, None when it needs a long name."""
+    if name in (".", ".."):
+        return name.ljust(11)
+    base, dot, extension = name.rpartition(".")
+    if not dot:
+        base, extension = name, ""
+    if not 1 <= len(base) <= 8 or len(extension) > 3:
+        return None
+    if not SHORT_NAME_CHARACTERS.issuperset(base + extension):
+        return None
+    return base.ljust(8) + extension.ljust(3)
+
+
+def basis(name: str):
+    """Split `name` in the upper case base and extension its short names
+    are derived from, invalid characters replaced."""
+
+    def clean(part):
+        return "".join(
+            c if c in SHORT_NAME_CHARACTERS else "_" for c in part if c not in " ."
+        )
+
+    name = name.upper().lstrip(".")
+    base, dot, extension = name.rpartition(".")
+    if not dot:
+        base, extension = name, ""
+    return clean(base) or "_", clean(extension)[:3]
+
+
+def generate_short_name(name: str, taken):
+    """Return an unused 11 character short name for the long name `name`.
+
+    `taken` holds the upper case names present in the directory. A name
+    that is a valid 8.3 name once upper cased keeps it, without a numeric
+    tail. Otherwise the first four candidates are "BASE~1" to "BASE~4",
+    after that a hash of the long name is part of the base, so files sharing
+    a prefix don't probe through each other's numbers and creating many of
+    them stays linear.
+    """
+    short = to_short_name(name.upper())
+    if short is not None and short_name(short) not in taken:
+        return short
+    base, extension = basis(name)
+
+    def candidate(prefix, n):
+        tail = f"~{n}"
+        return prefix[: 8 - len(tail)] + tail
+
+    def free(short):
+        return (f"{short}.{extension}" if extension else short) not in taken
+
+    for n in range(1, 5):
+        short = candidate(base, n)
+        if free(short):
+            return short.ljust(8) + extension.ljust(3)
+    prefix = base[:2] + f"{zlib.crc32(name.encode('utf-16-le')) & 0xFFFF:04X}"
+    for n in itertools.count(1):
+        short = candidate(prefix, n)
+        if free(short):
+            return short.ljust(8) + extension.ljust(3)
+
+
+def n_long_entries(name: str):
+    return -(-len(name.encode("utf-16-le")) // (2 * LFN_CHARACTERS))
+
+
+def n_slots(name: str):
+    """Number of directory slots taken by the entry for `name`."""
+    return 1 if to_short_name(name) is not None else 1 + n_long_entries(name)
+
+
+def encode_long_name(name: str, short: str):
+    """Return the long name slots of `name` for the short name `short`, in
+    the order they are stored, the last part first."""
+    data = name.encode("utf-16-le")
+    if len(data) > 2 * MAX_NAME_LENGTH:
+        raise Exception("name is too long")
+    # Terminated by a null character unless it fills the slots, padded with 0xFFFF
+    length = 2 * LFN_CHARACTERS * n_long_entries(name)
+    if len(data) < length:
+        data += b"\x00\x00"
+    data = data.ljust(length, b"\xff")
+
+    value = checksum(short.encode("latin-1"))
+    count = length // (2 * LFN_CHARACTERS)
+    slots = []
+    for order in range(count, 0, -1):
+        part = data[(order - 1) * 26 : order * 26].decode("latin-1")
+        slots.append(
+            LfnEntry.encode(
+                {
+                    "order": order | (LAST_LONG_ENTRY if order == count else 0),
+                    "name1": part[0:10],
+                    "attr": DirectoryAttr.ATTR_LONG_NAME,
+                    "type": 0,
+                    "checksum": value,
+                    "name2": part[10:22],
+                    "first_cluster_lo": 0,
+                    "name3": part[22:26],
+                }
+            )
+        )
+    return slots
+
+
+class LongName:
+    """Collects the long name slots preceding a short entry."""
+
+    def __init__(self):
+        self.parts = []
+
+    def reset(self):
+        self.parts = []
+
+    def add(self, entry: LfnEntry):
+        order = entry.order & ORDER_MASK
+        if not 1 <= order <= MAX_LONG_ENTRIES:
+            # Deleted slot, or garbage
+            self.parts = []
+        elif entry.order & LAST_LONG_ENTRY:
+            self.parts = [entry]
+        elif self.parts and order == (self.parts[-1].order & ORDER_MASK) - 1:
+            self.parts.append(entry)
+        else:
+            self.parts = []
+
+    def take(self, raw: str):
+        """Return the long name of the short entry named `raw` and start
+        over, None when the slots before it don't belong to it."""
+        parts, self.parts = self.parts, []
+        if not parts or parts[-1].order & ORDER_MASK != 1:
+            return None
+        value = checksum(raw.encode("latin-1"))
+        if any(part.checksum != value for part in parts):
+            return None
+        data = "".join(
+            part.name1 + part.name2 + part.name3 for part in reversed(parts)
+        ).encode("latin-1")
+        name = data.decode("utf-16-le", errors="replace")
+        end = name.find("\x00")
+        return name if end == -1 else name[:end]
+
+
+def with_long_names(entries):
+    """Pair every short entry of (sector index, offset, entry) tuples with
+    its long name, or None. Long name slots are consumed."""
+    long_name = LongName()
+    for sector_index, offset, entry in entries:
+        if isinstance(entry, LfnEntry):
+            long_name.add(entry)
+        else:
+            yield sector_index, offset, entry, long_name.take(entry.name)
@@ -0,0 +1,271 @@
+import argparse
+import os
+import struct
+
+from fat import (
+    FSINFO_LEAD_SIGNATURE,
+    FSINFO_STRUCT_SIGNATURE,
+    FSINFO_TRAIL_SIGNATURE,
+    data_sector_count,
+    root_dir_sector_count,
+)
+from table import FAT12_CLUSTERS, FAT16_CLUSTERS, TABLES
+from util import SECTOR_LENGTH, BpbFat16, BpbFat32, FsInfo, Partition
+
+# Smallest and largest cluster count of every FAT type
+CLUSTER_LIMITS = {
+    12: (1, FAT12_CLUSTERS - 1),
+    16: (FAT12_CLUSTERS, FAT16_CLUSTERS - 1),
+    32: (FAT16_CLUSTERS, 0x0FFFFFF5),
+}
+MEDIA_DESCRIPTOR = 0xF8
+PARTITION_OFFSET = 2048
+PARTITION_TYPES = {12: 0x01, 16: 0x06, 32: 0x0C}
+FAT32_RESERVED_SECTORS = 32
+FAT32_ROOT_CLUSTER = 2
+FAT32_FSINFO_SECTOR = 1
+FAT32_BACKUP_BOOT_SECTOR = 6
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(size: str) -> int:
+    suffix = size[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        return int(size[:-1]) * SIZE_SUFFIXES[suffix]
+    return int(size)
+
+
+def sectors_per_fat(
+    total_sectors,
+    n_reserved_sectors,
+    n_fats,
+    n_root_dir_sectors,
+    n_sectors_per_cluster,
+    bits=16,
+):
+    """Return the smallest FAT size holding an entry for every cluster that
+    is left once the FAT itself is accounted for, and that cluster count."""
+    n_sectors_per_fat = 1
+    while True:
+        data_sectors = data_sector_count(
+            total_sectors,
+            n_reserved_sectors,
+            n_fats,
+            n_sectors_per_fat,
+            n_root_dir_sectors,
+        )
+        n_clusters = data_sectors // n_sectors_per_cluster
+        if -(-(n_clusters + 2) * bits // 8) <= n_sectors_per_fat * SECTOR_LENGTH:
+            return n_sectors_per_fat, n_clusters
+        n_sectors_per_fat += 1
+
+
+def geometry(
+    total_sectors,
+    n_sectors_per_cluster=None,
+    n_root_entries=512,
+    n_fats=2,
+    n_reserved_sectors=1,
+    fat_type=16,
+):
+    """Return (sectors per cluster, sectors per FAT, cluster count).
+
+    Without an explicit cluster size the smallest one that keeps the cluster
+    count within the limit of the FAT type is chosen.
+    """
+    n_root_dir_sectors = root_dir_sector_count(n_root_entries, SECTOR_LENGTH)
+    n_min_clusters, n_max_clusters = CLUSTER_LIMITS[fat_type]
+    candidates = (
+        [n_sectors_per_cluster] if n_sectors_per_cluster else [1 << i for i in range(8)]
+    )
+    for n_sectors_per_cluster in candidates:
+        n_sectors_per_fat, n_clusters = sectors_per_fat(
+            total_sectors,
+            n_reserved_sectors,
+            n_fats,
+            n_root_dir_sectors,
+            n_sectors_per_cluster,
+            TABLES[fat_type].bits,
+        )
+        if n_clusters <= n_max_clusters:
+            break
+    if not n_min_clusters <= n_clusters <= n_max_clusters:
+        raise Exception(f"{n_clusters} clusters do not fit FAT{fat_type}")
+    return n_sectors_per_cluster, n_sectors_per_fat, n_clusters
+
+
+def mkfs(
+    path,
+    size,
+    n_sectors_per_cluster=None,
+    n_root_entries=512,
+    n_fats=2,
+    label="NO NAME",
+    partition=True,
+    fat_type=16,
+):
+    """Create a FAT image of `size` bytes at `path`.
+
+    The file is created sparse, only the MBR, the boot sector and the FAT
+    copies are written, the root directory and data area stay holes.
+    """
+    n_sectors = size // SECTOR_LENGTH
+    offset = PARTITION_OFFSET if partition else 0
+    total_sectors = n_sectors - offset
+    if fat_type == 32:
+        n_root_entries = 0
+        n_reserved_sectors = FAT32_RESERVED_SECTORS
+    else:
+        n_reserved_sectors = 1
+    n_sectors_per_cluster, n_sectors_per_fat, n_clusters = geometry(
+        total_sectors,
+        n_sectors_per_cluster,
+        n_root_entries,
+        n_fats,
+        n_reserved_sectors,
+        fat_type,
+    )
+
+    values = {
+        "jump_boot": 0x903CEB if fat_type != 32 else 0x9058EB,
+        "oem_name": "MSWIN4.1",
+        "n_bytes_per_sector": SECTOR_LENGTH,
+        "n_sectors_per_cluster": n_sectors_per_cluster,
+        "n_reserved_sectors": n_reserved_sectors,
+        "n_fats": n_fats,
+        "n_root_entries": n_root_entries,
+        "small_sector_count": (
+            total_sectors if total_sectors < 0x10000 and fat_type != 32 else 0
+        ),
+        "media_descriptor": MEDIA_DESCRIPTOR,
+        "n_sectors_per_fat16": n_sectors_per_fat if fat_type != 32 else 0,
+        "sectors_per_track": 32,
+        "n_heads": 64,
+        "hidden_sectors": offset,
+        "large_sector_count": (
+            total_sectors if total_sectors >= 0x10000 or fat_type == 32 else 0
+        ),
+        "drive_number": 0x80,
+        "windows_nt_flags": 0,
+        "signature": 0x29,
+        "volume_id": int.from_bytes(os.urandom(4), "little"),
+        "volume_label": label[:11].ljust(11),
+        "system_identifier": f"FAT{fat_type}".ljust(8),
+    }
+    boot_sector = bytearray(SECTOR_LENGTH)
+    if fat_type == 32:
+        values.update(
+            {
+                "n_sectors_per_fat32": n_sectors_per_fat,
+                "ext_flags": 0,
+                "fs_version": 0,
+                "root_cluster": FAT32_ROOT_CLUSTER,
+                "fs_info": FAT32_FSINFO_SECTOR,
+                "backup_boot_sector": FAT32_BACKUP_BOOT_SECTOR,
+            }
+        )
+        BpbFat32.encode_into(boot_sector, 0, values)
+    else:
+        BpbFat16.encode_into(boot_sector, 0, values)
+    boot_sector[510:512] = b"\x55\xaa"
+
+    # Every FAT copy in one buffer, only the reserved entries are set, and on
+    # FAT32 the end of the root directory chain
+    fat_length = n_sectors_per_fat * SECTOR_LENGTH
+    fats = bytearray(n_fats * fat_length)
+    for i in range(n_fats):
+        if fat_type == 12:
+            fats[i * fat_length : i * fat_length + 3] = bytes(
+                (MEDIA_DESCRIPTOR, 0xFF, 0xFF)
+            )
+        elif fat_type == 16:
+            struct.pack_into(
+                "<HH", fats, i * fat_length, 0xFF00 | MEDIA_DESCRIPTOR, 0xFFFF
+            )
+        else:
+            struct.pack_into(
+                "<III",
+                fats,
+                i * fat_length,
+                0x0FFFFF00 | MEDIA_DESCRIPTOR,
+                0x0FFFFFFF,
+                0x0FFFFFFF,
+            )
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, n_sectors * SECTOR_LENGTH)
+        if partition:
+            mbr = bytearray(SECTOR_LENGTH)
+            Partition.encode_into(
+                mbr,
+                446,
+                {
+                    "indicator": 0,
+                    "start_chs": 0,
+                    "type": PARTITION_TYPES[fat_type],
+                    "end_chs": 0,
+                    "sector": offset,
+                    "size": total_sectors,
+                },
+            )
+            mbr[510:512] = b"\x55\xaa"
+            os.pwrite(fd, mbr, 0)
+        os.pwrite(fd, boot_sector, offset * SECTOR_LENGTH)
+        if fat_type == 32:
+            fsinfo = bytearray(SECTOR_LENGTH)
+            FsInfo.encode_into(
+                fsinfo,
+                0,
+                {
+                    "lead_signature": FSINFO_LEAD_SIGNATURE,
+                    "struct_signature": FSINFO_STRUCT_SIGNATURE,
+                    # The root directory takes the first cluster
+                    "free_count": n_clusters - 1,
+                    "next_free": FAT32_ROOT_CLUSTER + 1,
+                    "trail_signature": FSINFO_TRAIL_SIGNATURE,
+                },
+            )
+            for sector in (0, FAT32_BACKUP_BOOT_SECTOR):
+                os.pwrite(fd, boot_sector, (offset + sector) * SECTOR_LENGTH)
+                os.pwrite(
+                    fd,
+                    fsinfo,
+                    (offset + sector + FAT32_FSINFO_SECTOR) * SECTOR_LENGTH,
+                )
+        os.pwrite(fd, fats, (offset + n_reserved_sectors) * SECTOR_LENGTH)
+    finally:
+        os.close(fd)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("device")
+    parser.add_argument("size", help="image size in bytes, K, M or G suffixes")
+    parser.add_argument("-c", "--sectors-per-cluster", type=int)
+    parser.add_argument("-r", "--root-entries", type=int, default=512)
+    parser.add_argument("-f", "--fats", type=int, default=2)
+    parser.add_argument("-F", "--fat-type", type=int, choices=(12, 16, 32), default=16)
+    parser.add_argument("-n", "--label", default="NO NAME")
+    parser.add_argument("--no-partition", action="store_true")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    mkfs(
+        args.device,
+        parse_size(args.size),
+        args.sectors_per_cluster,
+        args.root_entries,
+        args.fats,
+        args.label,
+        not args.no_partition,
+        args.fat_type,
+    )
+
+
+if __name__ == "__main__":
+    main()
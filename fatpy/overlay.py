@@ -0,0 +1,123 @@
+import os
+
+from device import BlockDevice
+from util import SECTOR_LENGTH, synchronized
+
+
+def runs_of(bitmap):
+    """Yield (first index, count) for each run of ones in `bitmap`."""
+    index = bitmap.find(1)
+    while index != -1:
+        end = bitmap.find(0, index)
+        if end == -1:
+            end = len(bitmap)
+        yield index, end - index
+        index = bitmap.find(1, end)
+
+
+class OverlayDevice(BlockDevice):
+    """Copy-on-write view of a base image that is only read.
+
+    The base is mapped privately, so mounting copies nothing and modified
+    sectors live in the pages they dirtied. With a `delta` path they are
+    written to that sparse file at their own offset, followed by one byte per
+    sector telling which sectors it holds, and loaded back on the next mount.
+    The base must not change while it is mounted, except through `commit`.
+    """
+
+    def __init__(self, device: str, delta=None, sector_length=SECTOR_LENGTH):
+        super().__init__(device, False, sector_length)
+        # Writes go to the delta, or nowhere without one
+        self.writable = True
+        # One byte per sector, 1 when it differs from the base
+        self.modified = bytearray(self.n_sectors)
+        # Name -> (first sector, data) runs of the modified sectors
+        self.snapshots = {}
+        self.delta = delta
+        self.delta_fd = None
+        if delta is not None:
+            self.delta_fd = os.open(delta, os.O_RDWR | os.O_CREAT, 0o644)
+            self.load_delta()
+
+    def load_delta(self):
+        map_offset = self.n_sectors * self.sector_length
+        present = os.pread(self.delta_fd, self.n_sectors, map_offset)
+        self.modified[: len(present)] = present
+        for index, count in runs_of(self.modified):
+            start = index * self.sector_length
+            length = count * self.sector_length
+            self.view[start : start + length] = os.pread(self.delta_fd, length, start)
+
+    @synchronized
+    def mark_dirty(self, index, count=1):
+        self.dirty.update(range(index, index + count))
+        self.modified[index : index + count] = b"\x01" * count
+
+    def write_runs(self, runs):
+        if self.delta_fd is None:
+            return
+        map_offset = self.n_sectors * self.sector_length
+        for index, data in runs:
+            count = len(data) // self.sector_length
+            os.pwrite(self.delta_fd, data, index * self.sector_length)
+            os.pwrite(
+                self.delta_fd, self.modified[index : index + count], map_offset + index
+            )
+
+    def fsync(self):
+        if self.delta_fd is not None:
+            os.fsync(self.delta_fd)
+
+    def modified_runs(self):
+        for index, count in runs_of(self.modified):
+            start = index * self.sector_length
+            yield index, self.view[start : start + count * self.sector_length]
+
+    @synchronized
+    def snapshot(self, name):
+        """Keep a copy of the modified sectors under `name`."""
+        self.snapshots[name] = [
+            (index, bytes(data)) for index, data in self.modified_runs()
+        ]
+
+    @synchronized
+    def restore(self, name):
+        """Bring every sector back to its contents when `name` was taken."""
+        runs = self.snapshots[name]
+        for index, count in runs_of(self.modified):
+            start = index * self.sector_length
+            length = count * self.sector_length
+            self.view[start : start + length] = os.pread(self.fd, length, start)
+            self.dirty.update(range(index, index + count))
+        self.modified = bytearray(self.n_sectors)
+        for index, data in runs:
+            count = len(data) // self.sector_length
+            start = index * self.sector_length
+            self.view[start : start + len(data)] = data
+            self.modified[index : index + count] = b"\x01" * count
+            self.dirty.update(range(index, index + count))
+
+    @synchronized
+    def commit(self):
+        """Write the modified sectors into the base and start an empty delta.
+
+        Snapshots are dropped, they are relative to the former base.
+        """
+        fd = os.open(self.device, os.O_RDWR)
+        try:
+            for index, data in self.modified_runs():
+                os.pwrite(fd, data, index * self.sector_length)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.modified = bytearray(self.n_sectors)
+        self.dirty.clear()
+        self.snapshots.clear()
+        if self.delta_fd is not None:
+            os.ftruncate(self.delta_fd, 0)
+            os.fsync(self.delta_fd)
+
+    def close(self):
+        super().close()
+        if self.delta_fd is not None:
+            os.close(self.delta_fd)
@@ -1,9 +1,51 @@
 import re
+from contextlib import nullcontext
 
+from check import check
 from colors import Color
+from defrag import defrag, fragmentation
 from filesystem import FileSystem
+from transfer import export_tree, import_tree
 from util import DirectoryAttr
 
+# Command name -> pattern of the whole command line and the Shell method
+# handling it. Lines are dispatched on their first word, so each line is
+# matched against a single precompiled pattern.
+COMMANDS = {
+    "import": (r"import (\S+) (\S+)", "import_tree"),
+    "export": (r"export (\S+) (\S+)", "export_tree"),
+    "set": (r"set ([0123])", "set_partition"),
+    "sec": (r"sec ([0-9]+)", "sector"),
+    "fat": (r"fat", "fat"),
+    "nonempty": (r"nonempty", "nonempty"),
+    "sync": (r"sync", "sync"),
+    "free": (r"free", "free"),
+    "df": (r"df", "df"),
+    "stats": (r"stats", "stats"),
+    "check": (r"check( repair)?", "check"),
+    "mbr": (r"mbr", "mbr"),
+    "cwd": (r"cwd", "cwd"),
+    "bpb": (r"bpb", "bpb"),
+    "mkdir": (r"mkdir (\S+)", "mkdir"),
+    "cd": (r"cd (\S+)", "cd"),
+    "touch": (r"touch (\S+)", "touch"),
+    "rm": (r"rm (\S+)", "rm"),
+    "mv": (r"mv (\S+) (\S+)", "mv"),
+    "ls": (r"ls", "ls"),
+    "find": (r"find ?(\S*)", "find"),
+    "cat": (r"cat (\S+)", "cat"),
+    "snapshot": (r"snapshot (\S+)", "snapshot"),
+    "restore": (r"restore (\S+)", "restore"),
+    "commit": (r"commit", "commit"),
+    "frag": (r"frag", "fragmentation"),
+    "defrag": (r"defrag", "defrag"),
+}
+COMMANDS = {
+    name: (re.compile(pattern), handler)
+    for name, (pattern, handler) in COMMANDS.items()
+}
+OUTPUT_BATCH = 1024
+
 
 class Shell:
     def __init__(self, fs: FileSystem):
@@ -11,49 +53,158 @@ class Shell:
         self.index = 0
 
     def parse(self, cmd):
-        value = "unknown"
-        if m := re.search(r"set ([0123])", cmd):
-            self.index = int(m.group(1))
-            index = int(m.group(1))
-            if index not in self.fs.fat:
-                value = f"partition {index} is not formatted with fat"
-        elif m := re.search(r"sec ([0-9]+)", cmd):
-            index = int(m.group(1))
-            if index >= len(self.fs.sectors):
-                value = f"sector {index} does not exist"
+        cmd = cmd.strip()
+        name = cmd.split(" ", 1)[0]
+        if name not in COMMANDS:
+            return "unknown"
+        pattern, handler = COMMANDS[name]
+        m = pattern.fullmatch(cmd)
+        if m is None:
+            return "unknown"
+        return getattr(self, handler)(m)
+
+    def execute(self, cmd):
+        """Run one command. With a journal it is committed on its own, so a
+        crash loses no command that returned."""
+        with self.fs.transaction() if self.fs.journal else nullcontext():
+            return self.parse(cmd)
+
+    def run(self, lines, out):
+        """Run a script non-interactively, writing the output to `out`.
+
+        Without a journal all commands of the script share one transaction,
+        the dirty sectors are written back once at the end when the device
+        is writable. Output is written in batches of lines.
+        """
+        buffer = []
+        with nullcontext() if self.fs.journal else self.fs.transaction():
+            for line in lines:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    value = self.execute(line)
+                except Exception as e:
+                    value = e
+                if value != "":
+                    buffer.append(str(value))
+                if len(buffer) >= OUTPUT_BATCH:
+                    out.write("\n".join(buffer) + "\n")
+                    buffer = []
+        if buffer:
+            out.write("\n".join(buffer) + "\n")
+        out.flush()
+
+    def import_tree(self, m):
+        n = import_tree(self.fs.fat[self.index], m.group(1), m.group(2))
+        return f"imported {n} entries"
+
+    def export_tree(self, m):
+        n = export_tree(self.fs.fat[self.index], m.group(1), m.group(2))
+        return f"exported {n} entries"
+
+    def set_partition(self, m):
+        self.index = int(m.group(1))
+        if self.index not in self.fs.fat:
+            return f"partition {self.index} is not formatted with fat"
+        return "unknown"
+
+    def sector(self, m):
+        index = int(m.group(1))
+        if index >= len(self.fs.sectors):
+            return f"sector {index} does not exist"
+        return self.fs.sectors[index]
+
+    def fat(self, m):
+        return self.fs.fat[self.index]
+
+    def nonempty(self, m):
+        return self.fs.fat[self.index].get_nonempty()
+
+    def sync(self, m):
+        self.fs.sync()
+        return ""
+
+    def free(self, m):
+        return self.fs.fat[self.index].free_space()
+
+    def df(self, m):
+        free = self.fs.map(lambda fat: fat.free_space())
+        return "\n".join(f"{i}: {free[i]}" for i in free)
+
+    def stats(self, m):
+        stats = self.fs.stats()
+        return "\n".join(f"{key}: {stats[key]}" for key in stats)
+
+    def check(self, m):
+        problems = check(self.fs.fat[self.index], repair=bool(m.group(1)))
+        return "\n".join(str(problem) for problem in problems) or "clean"
+
+    def fragmentation(self, m):
+        return fragmentation(self.fs.fat[self.index])
+
+    def defrag(self, m):
+        before, after = defrag(self.fs.fat[self.index])
+        return f"before: {before}\nafter: {after}"
+
+    def mbr(self, m):
+        return self.fs.mbr
+
+    def cwd(self, m):
+        return self.fs.fat[self.index].cwd
+
+    def bpb(self, m):
+        return self.fs.fat[self.index].get_bpb()
+
+    def mkdir(self, m):
+        self.fs.fat[self.index].f_opendir(m.group(1))
+        return ""
+
+    def cd(self, m):
+        self.fs.fat[self.index].chdir(m.group(1))
+        return ""
+
+    def touch(self, m):
+        self.fs.fat[self.index].f_open(m.group(1))
+        return ""
+
+    def rm(self, m):
+        self.fs.fat[self.index].f_unlink(m.group(1))
+        return ""
+
+    def mv(self, m):
+        self.fs.fat[self.index].f_rename(m.group(1), m.group(2))
+        return ""
+
+    def ls(self, m):
+        fs = self.fs.fat[self.index].f_readdir(self.fs.fat[self.index].cwd)
+        names = []
+        for i in range(len(fs)):
+            if fs[i].attr & DirectoryAttr.ATTR_DIRECTORY:
+                names.append(Color.blue(fs[i].name))
             else:
-                value = self.fs.sectors[index]
-        elif cmd == "fat":
-            value = self.fs.fat[self.index]
-        elif cmd == "nonempty":
-            value = self.fs.fat[self.index].get_nonempty()
-        elif cmd == "mbr":
-            value = self.fs.mbr
-        elif cmd == "cwd":
-            value = self.fs.fat[self.index].cwd
-        elif cmd == "bpb":
-            value = self.fs.fat[self.index].get_bpb()
-        elif m := re.search(r"mkdir ([A-Za-z0-9\/]+)", cmd):
-            self.fs.fat[self.index].f_opendir(m.group(1))
-            value = ""
-        elif m := re.search(r"cd ([A-Za-z0-9\.\/]+)", cmd):
-            self.fs.fat[self.index].chdir(m.group(1))
-            value = ""
-        elif m := re.search(r"touch ([A-Za-z0-9\/]+)", cmd):
-            self.fs.fat[self.index].f_open(m.group(1))
-            value = ""
-        elif m := re.search(r"rm (.+)", cmd):
-            value = m.group(1)
-        elif cmd == "ls":
-            fs = self.fs.fat[self.index].f_readdir(self.fs.fat[self.index].cwd)
-            names = []
-            for i in range(len(fs)):
-                if fs[i].attr & DirectoryAttr.ATTR_DIRECTORY:
-                    names.append(Color.blue(fs[i].name))
-                else:
-                    names.append(fs[i].name)
-            value = " ".join(names)
-        elif m := re.search(r"cat ([A-Za-z0-9\/]+)", cmd):
-            fp = self.fs.fat[self.index].f_open(m.group(1))
-            value = self.fs.fat[self.index].f_read(fp)
-        return value
+                names.append(fs[i].name)
+        return " ".join(names)
+
+    def find(self, m):
+        paths = []
+        for path, directories, files in self.fs.fat[self.index].walk(m.group(1) or "."):
+            prefix = "" if path == "/" else path
+            paths.extend(f"{prefix}/{info.name}" for info in directories + files)
+        return "\n".join(paths)
+
+    def cat(self, m):
+        fp = self.fs.fat[self.index].f_open(m.group(1))
+        return self.fs.fat[self.index].f_read(fp)
+
+    def snapshot(self, m):
+        self.fs.snapshot(m.group(1))
+        return ""
+
+    def restore(self, m):
+        self.fs.restore(m.group(1))
+        return ""
+
+    def commit(self, m):
+        self.fs.commit_overlay()
+        return ""
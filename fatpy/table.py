@@ -0,0 +1,440 @@
+import sys
+from array import array
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FREE_CLUSTER = 0x0000
+FIRST_CLUSTER = 2
+BAD_CLUSTER = 0xFFF7
+END_OF_CHAIN = 0xFFF8
+# Fewer clusters than these make a FAT12, respectively a FAT16
+FAT12_CLUSTERS = 4085
+FAT16_CLUSTERS = 65525
+# 32-bit array type code, "L" is 8 bytes wide on some platforms
+UINT32 = "I" if array("I").itemsize == 4 else "L"
+
+
+def fat_type(n_clusters):
+    """Return 12, 16 or 32, the FAT type is given by the cluster count alone."""
+    if n_clusters < FAT12_CLUSTERS:
+        return 12
+    if n_clusters < FAT16_CLUSTERS:
+        return 16
+    return 32
+
+
+class FatTable:
+    """In-memory copy of the FAT with a free-cluster bitmap.
+
+    The table is decoded once at mount. Updates go to the cached entries and
+    are written through to every FAT copy on disk. When NumPy is available
+    `view` shares memory with `entries` and the batch operations below are
+    vectorized, otherwise they fall back to pure Python.
+
+    This class handles FAT16, subclasses only change how entries are decoded
+    and encoded and the reserved values, so every FAT type shares the same
+    cluster operations.
+    """
+
+    bits = 16
+    typecode = "H"
+    bad_cluster = BAD_CLUSTER
+    end_of_chain = END_OF_CHAIN
+    end_of_file = 0xFFFF
+
+    def __init__(self, fat):
+        self.fat = fat
+        self.n_bytes_per_sector = fat.bpb.n_bytes_per_sector
+        n_entries = min(
+            fat.n_clusters + FIRST_CLUSTER,
+            fat.n_sectors_per_fat * self.n_bytes_per_sector * 8 // self.bits,
+        )
+        raw = fat.read_sectors(fat.first_fat_sector, fat.n_sectors_per_fat)
+        self.entries = self.load(raw, n_entries)
+        self.view = np.frombuffer(self.entries, dtype=self.typecode) if np else None
+
+        # One byte per cluster, 1 when the cluster is free. bytearray.find
+        # gives a C speed scan for the next free cluster.
+        if np:
+            self.free = bytearray((self.view == FREE_CLUSTER).astype(np.uint8))
+        else:
+            self.free = bytearray(map(FREE_CLUSTER.__eq__, self.entries))
+        self.free[:FIRST_CLUSTER] = bytes(FIRST_CLUSTER)
+        self.n_free = self.free.count(1)
+        self.hint = FIRST_CLUSTER
+
+    def load(self, raw, n_entries):
+        return self.decode(raw, n_entries)
+
+    def decode(self, raw, n_entries):
+        """Return the first `n_entries` entries of the on-disk FAT `raw`."""
+        entries = array(self.typecode)
+        entries.frombytes(raw[: n_entries * self.bits // 8])
+        if sys.byteorder == "big":
+            entries.byteswap()
+        return entries
+
+    def encode(self, first, last):
+        """Return (byte offset, bytes) of the entries first..last as stored."""
+        buffer = self.entries[first : last + 1]
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        return first * self.bits // 8, buffer.tobytes()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, cluster):
+        return self.entries[cluster]
+
+    def __setitem__(self, cluster, value):
+        was_free = self.free[cluster]
+        is_free = FIRST_CLUSTER <= cluster and value == FREE_CLUSTER
+        self.entries[cluster] = value
+        self.free[cluster] = is_free
+        self.n_free += is_free - was_free
+        self.write_through(cluster, cluster)
+
+    def write_through(self, first, last):
+        """Write the cached entries first..last to every FAT copy on disk."""
+        position, buffer = self.encode(first, last)
+        sector_index, offset = divmod(position, self.n_bytes_per_sector)
+        for i in range(self.fat.bpb.n_fats):
+            first_sector = self.fat.first_fat_sector + i * self.fat.n_sectors_per_fat
+            self.fat.write_sectors(first_sector + sector_index, offset, buffer)
+
+    def allocate(self, count, end, after=None):
+        """Allocate `count` clusters as a chain terminated by `end`.
+
+        A run of contiguous clusters is preferred, first directly after the
+        cluster `after`, which is linked to the new chain when given, then
+        anywhere on the disk. Only when no such run exists the clusters are
+        collected one by one. FAT sectors are written once per touched range.
+        """
+        if count > self.n_free:
+            raise Exception("no free clusters")
+
+        run = b"\x01" * count
+        if after is not None and self.free[after + 1 : after + 1 + count] == run:
+            clusters = range(after + 1, after + 1 + count)
+        else:
+            first = self.free.find(run, self.hint)
+            if first == -1:
+                first = self.free.find(run, FIRST_CLUSTER)
+            if first != -1:
+                clusters = range(first, first + count)
+            else:
+                clusters = []
+                for _ in range(count):
+                    clusters.append(self.find_free())
+                    self.free[clusters[-1]] = 0
+
+        for cluster, value in zip(clusters, list(clusters[1:]) + [end]):
+            self.entries[cluster] = value
+            self.free[cluster] = 0
+        self.n_free -= count
+        self.hint = clusters[-1] + 1
+
+        touched = list(clusters)
+        if after is not None:
+            self.entries[after] = clusters[0]
+            touched.append(after)
+        self.write_clusters(touched)
+        return list(clusters)
+
+    def release(self, clusters):
+        """Mark all `clusters` free with one write per contiguous range."""
+        clusters = [int(cluster) for cluster in clusters]
+        for cluster in clusters:
+            self.entries[cluster] = FREE_CLUSTER
+            if not self.free[cluster]:
+                self.free[cluster] = 1
+                self.n_free += 1
+        if clusters:
+            self.write_clusters(clusters)
+
+    def relocate(self, chains):
+        """Move chains to new clusters, `chains` holds (old clusters, new
+        clusters) pairs of equal length. The whole table is written once."""
+        chains = list(chains)
+        for old, _new in chains:
+            for cluster in old:
+                self.entries[cluster] = FREE_CLUSTER
+                self.free[cluster] = 1
+        for _old, new in chains:
+            for cluster, value in zip(new, new[1:] + [self.end_of_file]):
+                self.entries[cluster] = value
+                self.free[cluster] = 0
+        hint = self.free.find(1, FIRST_CLUSTER)
+        self.hint = FIRST_CLUSTER if hint == -1 else hint
+        self.write_through(FIRST_CLUSTER, len(self.entries) - 1)
+
+    def write_clusters(self, clusters):
+        clusters = sorted(clusters)
+        first = previous = clusters[0]
+        for cluster in clusters[1:] + [None]:
+            if cluster != previous + 1:
+                self.write_through(first, previous)
+                first = cluster
+            previous = cluster
+
+    def find_free(self):
+        """Return the next free cluster after the last one handed out, or None."""
+        cluster = self.free.find(1, self.hint)
+        if cluster == -1:
+            cluster = self.free.find(1, FIRST_CLUSTER, self.hint)
+        if cluster == -1:
+            return None
+        self.hint = cluster
+        return cluster
+
+    def is_cluster(self, value):
+        return FIRST_CLUSTER <= value < min(self.bad_cluster, len(self.entries))
+
+    def chain(self, cluster):
+        """Resolve the cluster chain starting at `cluster` into an index array.
+
+        Walking stops at the end-of-chain marker, at an invalid link or when
+        the chain loops back on itself.
+        """
+        clusters = array("L")
+        entries = self.entries
+        limit = len(entries)
+        while self.is_cluster(cluster) and len(clusters) < limit:
+            clusters.append(cluster)
+            cluster = entries[cluster]
+        if np:
+            return np.frombuffer(clusters, dtype=clusters.typecode)
+        return clusters
+
+    def runs(self, cluster):
+        """Return the chain starting at `cluster` as (first cluster, length) runs
+        of consecutive clusters."""
+        runs = []
+        for current in self.chain(cluster):
+            current = int(current)
+            if runs and runs[-1][0] + runs[-1][1] == current:
+                runs[-1][1] += 1
+            else:
+                runs.append([current, 1])
+        return [(first, length) for first, length in runs]
+
+    def chain_lengths(self):
+        """Return the length of the chain starting at every cluster.
+
+        All chains are resolved in one pass. Free clusters get 0 and clusters
+        whose chain loops back on itself get -1. A chain ends before a link
+        to a free cluster, as `invalid_links` reports it.
+        """
+        n = len(self.entries)
+        if np:
+            values = self.view.astype(np.int64)
+            used = values != FREE_CLUSTER
+            used[:FIRST_CLUSTER] = False
+            linked = (
+                used & (values >= FIRST_CLUSTER) & (values < min(self.bad_cluster, n))
+            )
+            # Pointer jumping, the index n is a terminal that every chain ends in
+            successor = np.append(np.where(linked, values, n), n)
+            lengths = np.append(used.astype(np.int64), 0)
+            for _ in range(n.bit_length() + 1):
+                lengths = lengths + lengths[successor]
+                successor = successor[successor]
+            lengths[successor != n] = -1
+            return lengths[:n]
+
+        lengths = array("l", bytes(n * array("l").itemsize))
+        state = bytearray(n)
+        for start in range(FIRST_CLUSTER, n):
+            if state[start] or self.entries[start] == FREE_CLUSTER:
+                continue
+            path = []
+            cluster = start
+            while (
+                self.is_cluster(cluster)
+                and not state[cluster]
+                and self.entries[cluster] != FREE_CLUSTER
+            ):
+                state[cluster] = 1
+                path.append(cluster)
+                cluster = self.entries[cluster]
+            if not self.is_cluster(cluster) or self.entries[cluster] == FREE_CLUSTER:
+                length = 0
+            elif state[cluster] == 1:
+                length = -1
+            else:
+                length = lengths[cluster]
+            for cluster in reversed(path):
+                if length != -1:
+                    length += 1
+                lengths[cluster] = length
+                state[cluster] = 2
+        return lengths
+
+    def invalid_links(self):
+        """Return the allocated clusters pointing at an out of range or a
+        free cluster."""
+        n = len(self.entries)
+        if np:
+            values = self.view[FIRST_CLUSTER:]
+            invalid = ((values == 1) | (values >= n)) & (values < self.bad_cluster)
+            linked = (values >= FIRST_CLUSTER) & (values < n)
+            invalid |= linked & (self.view[np.where(linked, values, 0)] == FREE_CLUSTER)
+            return np.flatnonzero(invalid) + FIRST_CLUSTER
+        entries = self.entries
+        return [
+            cluster
+            for cluster in range(FIRST_CLUSTER, n)
+            if entries[cluster] == 1
+            or n <= entries[cluster] < self.bad_cluster
+            or (
+                FIRST_CLUSTER <= entries[cluster] < n
+                and entries[entries[cluster]] == FREE_CLUSTER
+            )
+        ]
+
+    def count_free(self):
+        if np:
+            return int(np.count_nonzero(self.view[FIRST_CLUSTER:] == FREE_CLUSTER))
+        return self.entries[FIRST_CLUSTER:].count(FREE_CLUSTER)
+
+    def links(self):
+        """Return (cluster, next cluster) pairs for every link inside a chain."""
+        if np:
+            clusters = np.arange(FIRST_CLUSTER, len(self.view))
+            values = self.view[FIRST_CLUSTER:]
+            mask = (values >= FIRST_CLUSTER) & (
+                values < min(self.bad_cluster, len(self.view))
+            )
+            return clusters[mask], values[mask].astype(clusters.dtype)
+        clusters = array("L")
+        values = array("L")
+        for cluster in range(FIRST_CLUSTER, len(self.entries)):
+            value = self.entries[cluster]
+            if self.is_cluster(value):
+                clusters.append(cluster)
+                values.append(value)
+        return clusters, values
+
+    def cross_linked(self):
+        """Return the clusters that are the successor of more than one cluster."""
+        _clusters, values = self.links()
+        if np:
+            counts = np.bincount(values, minlength=len(self.view))
+            return np.flatnonzero(counts > 1)
+        return sorted(value for value, n in Counter(values).items() if n > 1)
+
+    def chain_heads(self):
+        """Return the allocated clusters that no other cluster links to.
+
+        Bad clusters are not part of any chain and are left out.
+        """
+        _clusters, values = self.links()
+        if np:
+            used = np.zeros(len(self.view), dtype=bool)
+            entries = self.view[FIRST_CLUSTER:]
+            used[FIRST_CLUSTER:] = (entries != FREE_CLUSTER) & (
+                entries != self.bad_cluster
+            )
+            used[values] = False
+            return np.flatnonzero(used)
+        linked = set(values)
+        return [
+            cluster
+            for cluster in range(FIRST_CLUSTER, len(self.entries))
+            if self.entries[cluster] not in (FREE_CLUSTER, self.bad_cluster)
+            and cluster not in linked
+        ]
+
+    def lost_chains(self, starts):
+        """Return the chain heads that are not among the known `starts`."""
+        heads = self.chain_heads()
+        if np:
+            return heads[~np.isin(heads, np.asarray(list(starts), dtype=heads.dtype))]
+        starts = set(starts)
+        return [head for head in heads if head not in starts]
+
+
+class Fat12Table(FatTable):
+    """FAT12, two entries packed in every three bytes."""
+
+    bits = 12
+    bad_cluster = 0xFF7
+    end_of_chain = 0xFF8
+    end_of_file = 0xFFF
+
+    def decode(self, raw, n_entries):
+        data = bytes(raw[: -(-n_entries * 3 // 2)])
+        if len(data) % 3:
+            data += bytes(3 - len(data) % 3)
+        if np:
+            triples = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+            triples = triples.astype(np.uint16)
+            pairs = np.empty((len(triples), 2), dtype=np.uint16)
+            pairs[:, 0] = triples[:, 0] | (triples[:, 1] & 0x0F) << 8
+            pairs[:, 1] = triples[:, 1] >> 4 | triples[:, 2] << 4
+            return array(self.typecode, pairs.ravel()[:n_entries].tobytes())
+        entries = array(self.typecode)
+        for i in range(0, len(data), 3):
+            entries.append(data[i] | (data[i + 1] & 0x0F) << 8)
+            entries.append(data[i + 1] >> 4 | data[i + 2] << 4)
+        del entries[n_entries:]
+        return entries
+
+    def encode(self, first, last):
+        # Widen to whole pairs so no entry shares a byte with one left out
+        first -= first % 2
+        last += 1 - last % 2
+        buffer = bytearray()
+        for cluster in range(first, last + 1, 2):
+            low = self.entries[cluster]
+            high = self.entries[cluster + 1] if cluster + 1 < len(self.entries) else 0
+            buffer += bytes((low & 0xFF, low >> 8 | (high & 0x0F) << 4, high >> 4))
+        return first * 3 // 2, bytes(buffer)
+
+
+class Fat32Table(FatTable):
+    """FAT32, 28-bit cluster numbers in 32-bit entries.
+
+    The 4 high bits are reserved and kept as found on disk.
+    """
+
+    bits = 32
+    typecode = UINT32
+    bad_cluster = 0x0FFFFFF7
+    end_of_chain = 0x0FFFFFF8
+    end_of_file = 0x0FFFFFFF
+
+    def load(self, raw, n_entries):
+        entries = super().decode(raw, n_entries)
+        # Cluster -> reserved bits, for the rare entries where they are set
+        self.reserved = {}
+        if entries and max(entries) >> 28:
+            for cluster, value in enumerate(entries):
+                if value >> 28:
+                    self.reserved[cluster] = value & 0xF0000000
+                    entries[cluster] = value & 0x0FFFFFFF
+        return entries
+
+    def decode(self, raw, n_entries):
+        entries = super().decode(raw, n_entries)
+        if entries and max(entries) >> 28:
+            for cluster, value in enumerate(entries):
+                entries[cluster] = value & 0x0FFFFFFF
+        return entries
+
+    def encode(self, first, last):
+        buffer = self.entries[first : last + 1]
+        for cluster, bits in self.reserved.items():
+            if first <= cluster <= last:
+                buffer[cluster - first] |= bits
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        return first * 4, buffer.tobytes()
+
+
+TABLES = {12: Fat12Table, 16: FatTable, 32: Fat32Table}
@@ -0,0 +1,122 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fat import Fat, N_FAT_ENTRY
+from lfn import n_slots
+from util import DirectoryAttr, FileDescriptor
+
+TRANSFER_WORKERS = 4
+
+
+def read_host_file(path):
+    with open(path, mode="rb") as f:
+        return f.read()
+
+
+def write_host_file(path, data):
+    with open(path, mode="wb") as f:
+        f.write(data)
+
+
+def clusters_for(fat: Fat, size):
+    return max(1, -(-size // fat.n_bytes_per_cluster))
+
+
+def plan_import(fat: Fat, host_dir):
+    """Collect the host tree and the number of clusters it needs."""
+    plan = []
+    n_clusters = 0
+    for host_path, directories, files in os.walk(host_dir):
+        directories.sort()
+        files.sort()
+        sizes = [os.path.getsize(os.path.join(host_path, name)) for name in files]
+        plan.append((host_path, directories, list(zip(files, sizes))))
+        slots = sum(map(n_slots, directories + files)) + 2
+        n_clusters += len(directories) + clusters_for(fat, slots * N_FAT_ENTRY) - 1
+        n_clusters += sum(clusters_for(fat, size) for size in sizes)
+    return plan, n_clusters
+
+
+def import_tree(fat: Fat, host_dir, image_path, workers=TRANSFER_WORKERS):
+    """Copy the host directory `host_dir` into the image directory `image_path`.
+
+    Space is checked for the whole tree before anything is written. Host files
+    are read by a thread pool a few files ahead of the thread writing them
+    into the image, each in one contiguous run of clusters when possible.
+    Returns the number of files and directories created.
+    """
+    plan, n_clusters = plan_import(fat, host_dir)
+    if n_clusters > fat.free_clusters():
+        raise Exception(
+            f"not enough space: {n_clusters} clusters needed, "
+            f"{fat.free_clusters()} free"
+        )
+
+    descriptors = {host_dir: fat.follow_path(image_path)}
+    window = deque()
+    n_created = 0
+    with fat.lock, ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def write_oldest():
+            fp, future = window.popleft()
+            fat.f_write(fp, future.result())
+
+        for host_path, directories, files in plan:
+            dp = descriptors[host_path]
+            for name in directories:
+                descriptors[os.path.join(host_path, name)] = (
+                    fat.create_file_or_directory(dp, name, DirectoryAttr.ATTR_DIRECTORY)
+                )
+                n_created += 1
+            for name, size in files:
+                future = pool.submit(read_host_file, os.path.join(host_path, name))
+                # The whole file is allocated now, the writes come later
+                fp = fat.create_file_or_directory(
+                    dp, name, DirectoryAttr.ATTR_ARCHIVE, clusters_for(fat, size)
+                )
+                window.append((fp, future))
+                n_created += 1
+                if len(window) > 2 * workers:
+                    write_oldest()
+        while window:
+            write_oldest()
+    return n_created
+
+
+def export_tree(fat: Fat, image_path, host_dir, workers=TRANSFER_WORKERS):
+    """Copy the image directory `image_path` into the host directory `host_dir`.
+
+    File contents are read from the image while a thread pool writes the
+    previous files to the host. Returns the number of files and directories
+    created.
+    """
+    top = fat.follow_path(image_path)
+    window = deque()
+    n_created = 0
+    os.makedirs(host_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, directories, files in fat.walk(image_path):
+            relative = path[len(image_path.rstrip("/")) :].lstrip("/")
+            target = os.path.join(host_dir, relative)
+            for info in directories:
+                os.makedirs(os.path.join(target, info.name), exist_ok=True)
+                n_created += 1
+            for info in files:
+                fp = FileDescriptor(
+                    info.cluster,
+                    fat.first_sector_of_cluster(info.cluster),
+                    info.attr,
+                    top.sector,
+                    info.size,
+                )
+                data = fat.f_pread(fp) if info.cluster else b""
+                window.append(
+                    pool.submit(write_host_file, os.path.join(target, info.name), data)
+                )
+                n_created += 1
+                if len(window) > 2 * workers:
+                    window.popleft().result()
+        while window:
+            window.popleft().result()
+    return n_created
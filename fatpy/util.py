@@ -1,3 +1,5 @@
+import functools
+import struct
 from dataclasses import dataclass
 
 SECTOR_LENGTH = 512
@@ -19,6 +21,17 @@ def pack(value, n):
     return buffer
 
 
+def synchronized(method):
+    """Run the method while holding the instance's `lock`."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 @dataclass
 class Field:
     name: str
@@ -53,6 +66,29 @@ bpb_fat16_fields = [
     Field("system_identifier", 54, 8, c_string=True),
 ]
 
+bpb_fat32_fields = [
+    Field("n_sectors_per_fat32", 36, 4),
+    Field("ext_flags", 40, 2),
+    Field("fs_version", 42, 2),
+    Field("root_cluster", 44, 4),
+    Field("fs_info", 48, 2),
+    Field("backup_boot_sector", 50, 2),
+    Field("drive_number", 64, 1),
+    Field("windows_nt_flags", 65, 1),
+    Field("signature", 66, 1),
+    Field("volume_id", 67, 4),
+    Field("volume_label", 71, 11, c_string=True),
+    Field("system_identifier", 82, 8, c_string=True),
+]
+
+fsinfo_fields = [
+    Field("lead_signature", 0, 4),
+    Field("struct_signature", 484, 4),
+    Field("free_count", 488, 4),
+    Field("next_free", 492, 4),
+    Field("trail_signature", 508, 4),
+]
+
 partition_fields = [
     Field("indicator", 0, 1),
     Field("start_chs", 1, 3),
@@ -88,19 +124,87 @@ fat_fields = [
     Field("file_size", 28, 4),
 ]
 
+# Long name slot, a part of up to 13 UTF-16 characters spread over three fields
+lfn_fields = [
+    Field("order", 0, 1),
+    Field("name1", 1, 10, c_string=True),
+    Field("attr", 11, 1),
+    Field("type", 12, 1),
+    Field("checksum", 13, 1),
+    Field("name2", 14, 12, c_string=True),
+    Field("first_cluster_lo", 26, 2),
+    Field("name3", 28, 4, c_string=True),
+]
+
+
+def compile_fields(fields):
+    """Compile a Field table into a little-endian struct.Struct.
+
+    Gaps between fields become pad bytes. C strings and integers that have
+    no struct code of their own are packed as raw bytes.
+    """
+    codes = {1: "B", 2: "H", 4: "I"}
+    layout = "<"
+    position = 0
+    for field in sorted(fields, key=lambda field: field.offset):
+        if field.offset > position:
+            layout += f"{field.offset - position}x"
+        if field.c_string or field.length not in codes:
+            layout += f"{field.length}s"
+        else:
+            layout += codes[field.length]
+        position = field.offset + field.length
+    return struct.Struct(layout)
+
 
 class Base:
-    def __init__(self, fields, buffer):
-        self.fields = fields
-        for field in fields:
-            if field.length == 1:
-                value = buffer[field.offset]
-            elif field.c_string:
-                chars = buffer[field.offset : field.offset + field.length]
-                value = "".join([chr(c) for c in chars])
-            else:
-                value = unpack(buffer[field.offset : field.offset + field.length])
-            setattr(self, field.name, value)
+    __slots__ = ()
+    fields = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = sorted(cls.fields, key=lambda field: field.offset)
+        cls.codec = compile_fields(fields)
+        cls.names = tuple(field.name for field in fields)
+        cls.strings = tuple(i for i, field in enumerate(fields) if field.c_string)
+        cls.integers = tuple(
+            (i, field.length)
+            for i, field in enumerate(fields)
+            if not field.c_string and field.length not in (1, 2, 4)
+        )
+
+    def __init__(self, buffer, offset=0):
+        if isinstance(buffer, Sector):
+            buffer = buffer.bytes
+        values = self.codec.unpack_from(buffer, offset)
+        if self.strings or self.integers:
+            values = list(values)
+            for i in self.strings:
+                values[i] = values[i].decode("latin-1")
+            for i, _length in self.integers:
+                values[i] = int.from_bytes(values[i], "little")
+        for name, value in zip(self.names, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def prepare(cls, values):
+        values = [values[name] for name in cls.names]
+        for i in cls.strings:
+            values[i] = values[i].encode("latin-1")
+        for i, length in cls.integers:
+            values[i] = values[i].to_bytes(length, "little")
+        return values
+
+    @classmethod
+    def encode(cls, values) -> bytes:
+        return cls.codec.pack(*cls.prepare(values))
+
+    @classmethod
+    def encode_into(cls, buffer, offset, values):
+        cls.codec.pack_into(buffer, offset, *cls.prepare(values))
+
+    def to_bytes(self) -> bytes:
+        return self.encode({name: getattr(self, name) for name in self.names})
 
     def __str__(self):
         fields = ",\n".join(
@@ -113,23 +217,38 @@ class Base:
 
 
 class Bpb(Base):
-    def __init__(self, buffer):
-        super().__init__(bpb_fields, buffer)
+    __slots__ = tuple(field.name for field in bpb_fields)
+    fields = bpb_fields
 
 
 class BpbFat16(Base):
-    def __init__(self, buffer):
-        super().__init__(bpb_fields + bpb_fat16_fields, buffer)
+    __slots__ = tuple(field.name for field in bpb_fields + bpb_fat16_fields)
+    fields = bpb_fields + bpb_fat16_fields
+
+
+class BpbFat32(Base):
+    __slots__ = tuple(field.name for field in bpb_fields + bpb_fat32_fields)
+    fields = bpb_fields + bpb_fat32_fields
+
+
+class FsInfo(Base):
+    __slots__ = tuple(field.name for field in fsinfo_fields)
+    fields = fsinfo_fields
 
 
 class Partition(Base):
-    def __init__(self, buffer):
-        super().__init__(partition_fields, buffer)
+    __slots__ = tuple(field.name for field in partition_fields)
+    fields = partition_fields
 
 
 class FatEntry(Base):
-    def __init__(self, buffer):
-        super().__init__(fat_fields, buffer)
+    __slots__ = tuple(field.name for field in fat_fields)
+    fields = fat_fields
+
+
+class LfnEntry(Base):
+    __slots__ = tuple(field.name for field in lfn_fields)
+    fields = lfn_fields
 
 
 @dataclass
@@ -140,12 +259,11 @@ class Mbr:
 
     @staticmethod
     def parse(buffer):
-        code_area = buffer[:446]
+        code_area = list(buffer[:446])
         start = 446
         partitions = []
         for i in range(4):
-            partition_buffer = buffer[start : start + 16]
-            partition = Partition(partition_buffer)
+            partition = Partition(buffer, start)
             start += 16
             partitions.append(partition)
 
@@ -156,7 +274,12 @@ class Mbr:
 
 class Sector:
     def __init__(self, bytes):
-        self.bytes = list(bytes)
+        # Sectors handed out by the block device are zero-copy views into the
+        # image, anything else gets its own writable buffer.
+        if isinstance(bytes, memoryview):
+            self.bytes = bytes
+        else:
+            self.bytes = memoryview(bytearray(bytes))
 
     def __str__(self):
         view = "\n".join(
@@ -181,6 +304,9 @@ class Sector:
     def __setitem__(self, index, value):
         self.bytes[index] = value
 
+    def __len__(self):
+        return len(self.bytes)
+
 
 class Descriptor:
     def __init__(self, cluster, sector, attr):
@@ -198,9 +324,11 @@ class DirectoryDescriptor(Descriptor):
 
 
 class FileDescriptor(Descriptor):
-    def __init__(self, cluster, sector, attr, dir_sector, size):
+    def __init__(self, cluster, sector, attr, dir_sector, size, dir_offset=0):
         super().__init__(cluster, sector, attr)
+        # Location of the directory entry describing the file
         self.dir_sector = dir_sector
+        self.dir_offset = dir_offset
         self.size = size
 
 
@@ -211,3 +339,4 @@ class FileInfo:
     date: int
     time: int
     attr: int
+    cluster: int = 0
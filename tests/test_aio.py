@@ -0,0 +1,135 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fatpy")
+)
+
+from aio import AsyncBlockDevice, AsyncFileSystem  # noqa: E402
+from filesystem import FileSystem  # noqa: E402
+from mkfs import mkfs  # noqa: E402
+
+TIMEOUT = 30
+
+
+class SlowDevice(AsyncBlockDevice):
+    """Image held in memory, every request takes `latency` seconds."""
+
+    def __init__(self, path, latency):
+        with open(path, "rb") as image:
+            self.data = bytearray(image.read())
+        super().__init__(len(self.data) // 512, writable=True)
+        self.latency = latency
+        self.n_reads = 0
+
+    async def read_blocks(self, index, count):
+        self.n_reads += 1
+        await asyncio.sleep(self.latency)
+        return bytes(self.data[index * 512 : (index + count) * 512])
+
+    async def write_blocks(self, index, buffer):
+        await asyncio.sleep(self.latency)
+        self.data[index * 512 : index * 512 + len(buffer)] = buffer
+
+
+def run(coroutine):
+    """Run `coroutine` on its own loop and thread, fail if it doesn't end:
+    a blocked loop can't time itself out."""
+    result = {}
+
+    def target():
+        result["value"] = asyncio.run(coroutine)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), "event loop hung"
+    return result["value"]
+
+
+def make_image(tmp_path, contents):
+    image = str(tmp_path / "image.img")
+    mkfs(image, 16 << 20)
+    fs = FileSystem(image, writable=True)
+    fat = fs.fat[0]
+    for path, data in contents.items():
+        fat.f_write(fat.f_open(path), data)
+    fs.sync()
+    return image
+
+
+def test_sync_while_reading(tmp_path):
+    contents = {f"/F{i}": os.urandom(20000) for i in range(8)}
+    device = SlowDevice(make_image(tmp_path, contents), latency=0.01)
+
+    async def main():
+        async with await AsyncFileSystem.open(device) as afs:
+            fat = afs.fat[0]
+            await fat.f_write(await fat.f_open("/NEW"), b"new data")
+            handles = [await fat.f_open(path) for path in contents]
+            # The reads load sectors on the loop while the sync waits on it
+            return await asyncio.gather(
+                afs.sync(), *(fat.f_pread(handle) for handle in handles)
+            )
+
+    _, *data = run(main())
+    assert data == list(contents.values())
+
+    async def reopen():
+        async with await AsyncFileSystem.open(device) as afs:
+            fat = afs.fat[0]
+            return await fat.f_pread(await fat.f_open("/NEW"))
+
+    assert run(reopen()) == b"new data"
+
+
+def test_mount_reads_pinned_ranges_at_once(tmp_path):
+    device = SlowDevice(make_image(tmp_path, {}), latency=0.05)
+
+    async def main():
+        async with await AsyncFileSystem.open(device):
+            pass
+
+    run(main())
+    # The boot sectors, the FAT copies and the root directory, not a
+    # request per sector
+    assert device.n_reads < 10
+
+
+def test_reads_run_concurrently(tmp_path):
+    contents = {f"/F{i}": os.urandom(4000) for i in range(8)}
+    device = SlowDevice(make_image(tmp_path, contents), latency=0.2)
+
+    async def main():
+        async with await AsyncFileSystem.open(device) as afs:
+            fat = afs.fat[0]
+            handles = [await fat.f_open(path) for path in contents]
+            start = time.perf_counter()
+            data = await asyncio.gather(*(fat.f_pread(handle) for handle in handles))
+            return data, time.perf_counter() - start
+
+    data, elapsed = run(main())
+    assert data == list(contents.values())
+    # One after the other the reads take 1.6 s
+    assert elapsed < 0.8
+
+
+def test_cache_is_bounded(tmp_path):
+    contents = {f"/F{i}": os.urandom(20000) for i in range(32)}
+    device = SlowDevice(make_image(tmp_path, contents), latency=0)
+    capacity = 64 << 10
+
+    async def main():
+        async with await AsyncFileSystem.open(device, cache_size=capacity) as afs:
+            fat = afs.fat[0]
+            for _ in range(2):
+                for path, expected in contents.items():
+                    assert await fat.f_pread(await fat.f_open(path)) == expected
+            return afs.fs.stats()
+
+    stats = run(main())
+    assert stats["evictions"] > 0
+    assert stats["cached"] * 512 <= capacity
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fatpy")
+)
+
+from check import check  # noqa: E402
+from filesystem import FileSystem  # noqa: E402
+from mkfs import mkfs  # noqa: E402
+
+
+def make_files(tmp_path, contents):
+    image = str(tmp_path / "image.img")
+    mkfs(image, 16 << 20)
+    fs = FileSystem(image, writable=True)
+    fat = fs.fat[0]
+    for path, data in contents.items():
+        fat.f_write(fat.f_open(path), data)
+    return image, fs, fat
+
+
+def repair(image, fs, fat):
+    """Repair, expecting problems, and return the partition mounted again."""
+    problems = check(fat, repair=True)
+    assert problems and all(problem.repaired for problem in problems)
+    fs.sync()
+    return FileSystem(image).fat[0]
+
+
+def head(fat, path):
+    return fat.lookup(0, path.lstrip("/"))[2]
+
+
+def test_repair_keeps_chain_linked_into(tmp_path):
+    a = os.urandom(3000)
+    b = os.urandom(3 * 2048)
+    image, fs, fat = make_files(tmp_path, {"/A": a, "/B": b})
+    # The last cluster of A links to the head of B
+    fat.write_fat(int(fat.table.chain(head(fat, "/A"))[-1]), head(fat, "/B"))
+
+    fat = repair(image, fs, fat)
+    assert check(fat) == []
+    assert fat.f_pread(fat.f_open("/B")) == b
+    assert fat.f_pread(fat.f_open("/A")) == a
+
+
+def test_repair_frees_lost_chain_only(tmp_path):
+    b = os.urandom(3 * 2048)
+    image, fs, fat = make_files(tmp_path, {"/B": b})
+    # An unreferenced chain runs into the middle of B
+    lost = fat.table.allocate(2, fat.end_of_file)
+    fat.write_fat(int(lost[-1]), int(fat.table.chain(head(fat, "/B"))[1]))
+
+    fat = repair(image, fs, fat)
+    assert check(fat) == []
+    assert fat.f_pread(fat.f_open("/B")) == b
@@ -0,0 +1,102 @@
+import filecmp
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fatpy")
+)
+
+from check import check  # noqa: E402
+from defrag import defrag, plan, tree_chains  # noqa: E402
+from fat import DELETED_ENTRY  # noqa: E402
+from filesystem import FileSystem  # noqa: E402
+from mkfs import mkfs  # noqa: E402
+from transfer import export_tree  # noqa: E402
+from util import DirectoryAttr  # noqa: E402
+
+
+def delete(fat, path):
+    """Free the chain of `path` and mark its short entry deleted by hand."""
+    dp = fat.follow_path(path.rsplit("/", 1)[0] or "/")
+    sector_index, offset, cluster, _attr = fat.lookup(dp.cluster, path.split("/")[-1])
+    fat.table.release(fat.table.chain(cluster))
+    fat.write_sector(sector_index, offset, bytes([DELETED_ENTRY]))
+    fat.dcache.clear()
+    fat.path_cache.clear()
+
+
+def assert_same_trees(left, right):
+    comparison = filecmp.dircmp(left, right)
+    assert not comparison.left_only and not comparison.right_only
+    _match, mismatch, errors = filecmp.cmpfiles(
+        left, right, comparison.common_files, shallow=False
+    )
+    assert not mismatch and not errors
+    for name in comparison.common_dirs:
+        assert_same_trees(os.path.join(left, name), os.path.join(right, name))
+
+
+@pytest.mark.parametrize(
+    "fat_type, size", [(12, 8 << 20), (16, 64 << 20), (32, 64 << 20)]
+)
+def test_defrag_keeps_contents(tmp_path, fat_type, size):
+    image = str(tmp_path / "image.img")
+    mkfs(
+        image, size, n_sectors_per_cluster=1 if fat_type == 32 else 4, fat_type=fat_type
+    )
+    fs = FileSystem(image, writable=True)
+    fat = fs.fat[0]
+    fat.f_opendir("/d")
+    fat.f_opendir("/d/sub")
+    paths = [f"/d/a long file name {i}.bin" for i in range(40)]
+    paths += [f"/d/sub/S{i}" for i in range(20)] + [f"/R{i}" for i in range(20)]
+    handles = {path: fat.f_open(path) for path in paths}
+    # Interleaved appends split every file into many extents
+    generator = random.Random(0)
+    for _ in range(400):
+        fat.f_write(
+            handles[generator.choice(paths)], os.urandom(generator.randint(1, 3000))
+        )
+    for path in paths[::7]:
+        delete(fat, path)
+    # A live entry whose attribute byte is 0 must survive the compaction
+    fat.f_chmod("/R1", 0, DirectoryAttr.ATTR_ARCHIVE)
+    fs.sync()
+    export_tree(fat, "/", str(tmp_path / "before"))
+
+    before, after = defrag(fat)
+    fs.sync()
+
+    assert before.n_fragmented > 0
+    assert after.n_fragmented == 0
+    assert after.n_free_extents == 1
+    assert after.n_chains == before.n_chains
+    fat = FileSystem(image).fat[0]
+    assert check(fat) == []
+    export_tree(fat, "/", str(tmp_path / "after"))
+    assert_same_trees(str(tmp_path / "before"), str(tmp_path / "after"))
+
+
+def test_plan_merges_overlapping_copies(tmp_path):
+    image = str(tmp_path / "image.img")
+    mkfs(image, 16 << 20, n_sectors_per_cluster=1)
+    fs = FileSystem(image, writable=True)
+    fat = fs.fat[0]
+    fat.f_write(fat.f_open("/GAP"), b"g")
+    data = os.urandom(20 * fat.n_bytes_per_cluster)
+    fat.f_write(fat.f_open("/DATA"), data)
+    delete(fat, "/GAP")
+
+    chains = [[int(c) for c in fat.table.chain(head)] for head in tree_chains(fat)]
+    _targets, copies = plan(fat, chains)
+    # Sliding the file one cluster down is a single copy onto itself
+    assert copies == [(chains[0][0], chains[0][0] - 1, 20)]
+
+    defrag(fat)
+    fs.sync()
+    fat = FileSystem(image).fat[0]
+    assert fat.f_pread(fat.f_open("/DATA")) == data
+    assert check(fat) == []
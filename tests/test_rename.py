@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fatpy")
+)
+
+from check import check  # noqa: E402
+from filesystem import FileSystem  # noqa: E402
+from mkfs import mkfs  # noqa: E402
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = str(tmp_path / "image.img")
+    mkfs(path, 16 << 20)
+    return path
+
+
+@pytest.mark.parametrize("new_path", ["/a much longer name", "/d/A"])
+def test_write_after_rename_moving_the_entry(image, new_path):
+    fs = FileSystem(image, writable=True)
+    fat = fs.fat[0]
+    fat.f_opendir("/d")
+    handle = fat.f_open("/A")
+    fat.f_rename("/A", new_path)
+    # Takes the slots A had
+    fat.f_open("/B")
+    handle.write(b"data")
+    handle.close()
+    fs.sync()
+
+    fat = FileSystem(image).fat[0]
+    assert check(fat) == []
+    assert fat.f_pread(fat.f_open(new_path)) == b"data"
+    assert fat.f_pread(fat.f_open("/B")) == b""
+
+
+def test_write_after_unlink(image):
+    fs = FileSystem(image, writable=True)
+    fat = fs.fat[0]
+    handle = fat.f_open("/A")
+    fat.f_unlink("/A")
+    with pytest.raises(Exception, match="file was removed"):
+        fat.f_write(handle, b"data")
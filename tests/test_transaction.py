@@ -0,0 +1,39 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fatpy")
+)
+
+from filesystem import FileSystem  # noqa: E402
+from mkfs import mkfs  # noqa: E402
+
+
+@pytest.mark.parametrize("journal", [False, True])
+def test_transaction_syncs_while_another_thread_is_in_one(tmp_path, journal):
+    image = str(tmp_path / "image.img")
+    mkfs(image, 16 << 20)
+    fs = FileSystem(image, writable=True, journal=journal)
+    fat = fs.fat[0]
+    entered = threading.Event()
+    release = threading.Event()
+
+    def other():
+        with fs.transaction():
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    entered.wait()
+    try:
+        with fs.transaction():
+            fat.f_write(fat.f_open("/A"), b"data")
+        # Sectors left dirty would be lost on a crash
+        assert not fs.sectors.dirty
+    finally:
+        release.set()
+        thread.join()